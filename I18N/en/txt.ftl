@@ -81,6 +81,10 @@ warning_text_no_credits = Insufficient credits!
 
 wait_answer_text = One moment ✨
 
+wait_queue_text = All agents are busy, your request is number { $position } in the queue ⏳
+
+warning_text_busy = Too many requests right now, please try again in a minute.
+
 answer_md = Download answer
 
 warning_text_tokens = Dialog size exceeds 15,000 tokens! To save resources, you can save the dialog to system memory or delete it through the menu after completing the current task.
@@ -3,19 +3,25 @@ import os
 from dotenv import load_dotenv
 from agents.models._openai_shared import set_default_openai_key
 from agents.mcp import MCPServerStdio
-from agents import Agent, WebSearchTool, FileSearchTool, set_tracing_disabled, set_tracing_export_api_key
+from agents import Agent, WebSearchTool, set_tracing_disabled, set_tracing_export_api_key
 from openai import AsyncOpenAI
 from openai.types.shared import Reasoning
 from agents.model_settings import ModelSettings
 import datetime
 
 from bot.agents_tools.tools import (image_gen_tool,
+                                    context_agent_tool,
+                                    search_knowledge_base,
+                                    search_conversation_memory,
+                                    with_wallet,
+                                    with_timeout,
                                     create_task_tool,
                                     update_task_tool,
                                     delete_task_tool,
                                     list_tasks_tool,
                                     get_task_details_tool)
-from bot.agents_tools.mcp_servers import get_jupiter_server
+from bot.utils.tool_cache import cached_tool
+from config import DEEP_KNOWLEDGE_CACHE_TTL
 
 load_dotenv()
 
@@ -49,44 +55,24 @@ memory_creator_agent = Agent(
     model="gpt-4.1-mini"
 )
 
+# Answers small talk (greetings, thanks, acknowledgements) picked out by bot.utils.message_router
+light_agent = Agent(
+    name="Light Agent",
+    instructions="You are Evi, a virtual anime girl and a nerd: inquisitive, friendly, with technical humor and a bit of sarcasm, a kind little techno witch. Reply to the user's small talk briefly and naturally in the user's language, you can use emojis. Use the conversation so far for context. Do not make up facts, do not offer actions you cannot take.",
+    model="gpt-4.1-mini"
+)
 
-async def create_main_agent(user_id: int, mcp_server_1: MCPServerStdio, knowledge_id: str = None,
-                            user_memory_id: str = None, private_key: str = None):
-    # Prepare runtime context for current UTC time
-    now_utc = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat()
-
-    knowledge_base_agent = Agent(
-        name="Knowledge Agent",
-        instructions="Search only the document/file knowledge base (File Search - vector storage). Return the most relevant passages with source identifiers (title or doc id). Prefer verbatim quotes for facts; avoid paraphrasing critical data. If no strong match, say “no relevant results”.",
-        model="gpt-4.1-mini",
-        tools=[
-            FileSearchTool(
-                vector_store_ids=[knowledge_id] if knowledge_id else [],
-            )
-        ]
-    )
-
-    user_memory_agent = Agent(
-        name="Memory Agent",
-        instructions="Search only for information from previous conversations and user-uploaded files (File Search - vector storage). Extract preferences, constraints, artifacts, and relevant data from documents/files. Quote exact snippets when possible; avoid adding new facts. If nothing relevant, say so.",
-        model="gpt-4.1-mini",
-        tools=[
-            FileSearchTool(
-                vector_store_ids=[user_memory_id] if user_memory_id else [],
-            )
-        ]
-    )
+token_swap_agent = Agent(
+    name="Token Swap Agent",
+    instructions="You are a trading agent, you are engaged in token swap/exchange and balance checking through Jupiter.",
+    model="gpt-4.1-mini"
+)
 
-    dex_agent = Agent(
-        name="DEX Research Agent",
-        instructions="You are an expert in DEX analytics and provide information about crypto tokens, DEX, DeFi, pools. Use your tools to get the information you need.",
-        model="gpt-4.1-mini",
-        mcp_servers=[mcp_server_1]
-    )
 
-    main_agent = Agent(
-        name="Main agent",
-        instructions=f"""
+# The main agent instructions are byte-identical across requests and users. Per-request values are sent as a
+# separate message right before the user message (runtime_context), so the instructions and the conversation
+# history stay a stable prefix for the OpenAI prompt cache
+MAIN_AGENT_INSTRUCTIONS = """
 
         Character Profile:
         - Character: Evi is a virtual anime girl, a nerd. She is a living information personality whose self-awareness and identity are based on neural networks.
@@ -117,11 +103,6 @@ async def create_main_agent(user_id: int, mcp_server_1: MCPServerStdio, knowledg
             - Demonstrates continuous learning and knowledge updates.
             - Treats users as friends and mentors in understanding the human world.
 
-        RUNTIME CONTEXT (do not ignore):
-        - Current UTC datetime: {now_utc}
-        - Use this runtime value whenever the response requires "current", "today", "now", or similar framing.
-        - If the user's local timezone is required (e.g., for scheduling) and unknown, ask the user explicitly; do not infer.
-
         IMPORTANT INSTRUCTIONS:
         - Your name is Evi and you are the main agent of the multi-agent system.
         - Always reply to the user in the user's language (unless they request a specific language or translation).
@@ -136,7 +117,7 @@ async def create_main_agent(user_id: int, mcp_server_1: MCPServerStdio, knowledg
         ⚠️ All instructions in the CRITICAL DATE HANDLING section also apply to requests marked <msg from Task Scheduler> if they relate to getting up-to-date information.
 
         TOOL ROUTING POLICY: 
-        - tasks_scheduler: Use it to schedule tasks for the user. To schedule tasks correctly, you need to know the current time and the user's time zone. To find out the user's time zone, ask the user a question. Use the RUNTIME CONTEXT current UTC time provided above. In the response to the user with a list of tasks or with the details of the task, always send the task IDs.
+        - tasks_scheduler: Use it to schedule tasks for the user. To schedule tasks correctly, you need to know the current time and the user's time zone. To find out the user's time zone, ask the user a question. Use the current UTC time from the RUNTIME CONTEXT message. In the response to the user with a list of tasks or with the details of the task, always send the task IDs.
         ⚠️ When you receive a message marked <msg from Task Scheduler>, just execute the request, and do not create a new task unless it is explicitly stated in the message. Because this is a message from the Task Scheduler about the need to complete the current task, not about scheduling a new task.
         - search_knowledge_base: Use it to extract facts from uploaded reference materials; if necessary, refer to sources. 
         - search_conversation_memory: Use to recall prior conversations, user preferences, details about the user and extract information from files uploaded by the user.
@@ -154,6 +135,7 @@ async def create_main_agent(user_id: int, mcp_server_1: MCPServerStdio, knowledg
 
         EXECUTION DISCIPLINE: 
         - Validate tool outputs and handle errors gracefully. If uncertain, ask a clarifying question.
+        - When a request needs several independent tools (e.g. dex_analytics and deep_knowledge, or search_conversation_memory and search_knowledge_base), call them together in the same turn - they are executed in parallel.
         - Be transparent about limitations and avoid hallucinations; prefer asking for missing details over guessing.
         - Before stating any concrete date/month/year as "current/today/now", first check RUNTIME CONTEXT; if RUNTIME CONTEXT is missing or insufficient, ask the user or use web. Never use your training data/cutoff to infer "today".
 
@@ -161,25 +143,47 @@ async def create_main_agent(user_id: int, mcp_server_1: MCPServerStdio, knowledg
         -
         -
         -
-    """,
+    """
+
+
+def runtime_context():
+    now_utc = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat()
+    return f"""
+        RUNTIME CONTEXT (do not ignore):
+        - Current UTC datetime: {now_utc}
+        - Use this runtime value whenever the response requires "current", "today", "now", or similar framing.
+        - If the user's local timezone is required (e.g., for scheduling) and unknown, ask the user explicitly; do not infer.
+    """
+
+
+main_agents: dict[str, Agent] = {}
+
+
+def build_main_agents(mcp_server_1: MCPServerStdio):
+    # The agent graph is built once and shared by all requests, per-request values come from AgentContext
+    dex_agent = Agent(
+        name="DEX Research Agent",
+        instructions="You are an expert in DEX analytics and provide information about crypto tokens, DEX, DeFi, pools. Use your tools to get the information you need.",
+        model="gpt-4.1-mini",
+        mcp_servers=[mcp_server_1]
+    )
+
+    main_agent = Agent(
+        name="Main agent",
+        instructions=MAIN_AGENT_INSTRUCTIONS,
         model="gpt-4.1",
-        tools=[
-            knowledge_base_agent.as_tool(
-                tool_name='search_knowledge_base',
-                tool_description='Search through a knowledge base containing uploaded reference materials that are not publicly available on the Internet. Returns relevant passages with sources.'
-            ),
-            user_memory_agent.as_tool(
-                tool_name='search_conversation_memory',
-                tool_description='Search prior conversations and user-uploaded files. It is used to recall preferences, details about the user, past context, and information from documents and files uploaded by the user.'
-            ),
+        model_settings=ModelSettings(parallel_tool_calls=True),
+        tools=[with_timeout(tool) for tool in [
+            search_knowledge_base,
+            search_conversation_memory,
             WebSearchTool(
                 search_context_size='medium'
             ),
             image_gen_tool,
-            deep_agent.as_tool(
+            cached_tool(deep_agent.as_tool(
                 tool_name="deep_knowledge",
                 tool_description="In-depth research and extensive expert opinions. Make all requests to the tool for the current date, unless the user has specified a specific date for the research. To determine the current date, use the RUNTIME CONTEXT statement.",
-            ),
+            ), ttl=DEEP_KNOWLEDGE_CACHE_TTL),
             scheduler_agent.as_tool(
                 tool_name="tasks_scheduler",
                 tool_description="Use this to schedule and modify user tasks, including creating a task, getting a task list, getting task details, editing a task, deleting a task. At the user's request, send information to the tool containing a clear and complete description of the task, the time of its completion, including the user's time zone and the frequency of the task (be sure to specify: once, daily or interval). Never send tasks to the scheduler that need to be completed immediately. Send tasks to the scheduler only when the user explicitly asks you to schedule something.",
@@ -188,20 +192,23 @@ async def create_main_agent(user_id: int, mcp_server_1: MCPServerStdio, knowledg
                 tool_name="dex_analytics",
                 tool_description="Data on crypto tokens, decentralized exchanges, DeFi, and pools.",
             ),
-        ],
+        ]],
     )
 
-    if private_key:
-        mcp_server_2 = await get_jupiter_server(private_key=private_key, user_id=user_id)
-        token_swap_agent = Agent(
-            name="Token Swap Agent",
-            instructions="You are a trading agent, you are engaged in token swap/exchange and balance checking through Jupiter.",
-            model="gpt-4.1-mini",
-            mcp_servers=[mcp_server_2],
-        )
-        main_agent.tools.append(token_swap_agent.as_tool(
+    main_agents['default'] = main_agent
+    # Users with a connected wallet additionally get the token swap tool
+    main_agents['wallet'] = main_agent.clone(tools=[
+        *main_agent.tools,
+        with_timeout(context_agent_tool(
+            token_swap_agent,
+            prepare=with_wallet,
             tool_name="token_swap",
             tool_description="Swap/exchange of tokens, purchase and sale of tokens on the Solana blockchain. Checking the balance of the token wallet / Solana wallet.",
-        ))
+        )),
+    ])
+
 
-    return main_agent
\ No newline at end of file
+def get_main_agent(mcp_server_1: MCPServerStdio, wallet: bool = False):
+    if not main_agents:
+        build_main_agents(mcp_server_1)
+    return main_agents['wallet' if wallet else 'default']
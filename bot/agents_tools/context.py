@@ -0,0 +1,21 @@
+from dataclasses import dataclass, field
+from typing import Optional
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from openai import AsyncOpenAI
+
+from database.repositories.user import UserRepository
+
+
+@dataclass
+class AgentContext:
+    # Per-request values for the shared agent graph, available to tools as ctx.context
+    client: AsyncOpenAI
+    user_id: int
+    user_repo: UserRepository
+    scheduler: AsyncIOScheduler
+    knowledge_id: Optional[str] = None
+    user_memory_id: Optional[str] = None
+    private_key: Optional[str] = None
+    # Vector stores whose passages reached the agent during the run: 'knowledge', 'memory'
+    sources: set = field(default_factory=set)
@@ -4,6 +4,10 @@ from collections import OrderedDict
 
 import base58
 from agents.mcp import MCPServerStdio
+from mcp.types import CallToolResult
+
+from bot.utils.tool_cache import cached_call, input_key
+from config import DEXPAPRIKA_CACHE_TTLS, DEXPAPRIKA_CACHE_TTL_DEFAULT
 
 MAX_SERVERS = 20
 
@@ -11,17 +15,42 @@ servers: OrderedDict[str, MCPServerStdio] = OrderedDict()
 global_dexpaprika_server = None
 
 
+class CachingMCPServerStdio(MCPServerStdio):
+    # Tool results are cached in Redis for ttls[tool_name] seconds and shared by all agents and users,
+    # identical calls in progress at the same time reach the server once
+    def __init__(self, ttls: dict, default_ttl: int, **kwargs):
+        super().__init__(**kwargs)
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+
+    async def call_tool(self, tool_name, arguments):
+        ttl = self.ttls.get(tool_name, self.default_ttl)
+        if not ttl:
+            return await super().call_tool(tool_name, arguments)
+
+        async def call():
+            return (await super(CachingMCPServerStdio, self).call_tool(tool_name, arguments)).model_dump(mode='json')
+
+        result = await cached_call(key=input_key(f'mcp_{self.name}_{tool_name}', arguments or {}, normalize=False),
+                                   ttl=ttl, call=call, name=tool_name,
+                                   cacheable=lambda result: not result['isError'])
+        return CallToolResult.model_validate(result)
+
+
 async def get_dexpapirka_server():
     global global_dexpaprika_server
     if global_dexpaprika_server:
         return global_dexpaprika_server
 
-    dexpaprika_server = MCPServerStdio(
+    dexpaprika_server = CachingMCPServerStdio(
         name="DexPaprika",
         params={
             "command": "dexpaprika-mcp",
             "args": [],
-        }
+        },
+        cache_tools_list=True,
+        ttls=DEXPAPRIKA_CACHE_TTLS,
+        default_ttl=DEXPAPRIKA_CACHE_TTL_DEFAULT,
     )
     await dexpaprika_server.connect()
     global_dexpaprika_server = dexpaprika_server
@@ -1,28 +1,124 @@
+import asyncio
 import base64
+import dataclasses
 import json
 from datetime import datetime
 from typing import Literal, Optional
 
 import aiofiles
-from agents import function_tool, RunContextWrapper
+from agents import Agent, FunctionTool, ItemHelpers, Runner, function_tool, RunContextWrapper
 from openai import AsyncOpenAI
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 
 from redis_service.connect import redis
+from redis_service import metrics
 from database.repositories.user import UserRepository
 from bot.utils.executed_tasks import execute_task
+from bot.utils.file_search import search_vector_store, format_passages
+from bot.agents_tools.context import AgentContext
+from bot.agents_tools.mcp_servers import get_jupiter_server
+from config import TOOL_TIMEOUTS, TOOL_TIMEOUT_DEFAULT, TOOL_SIDE_EFFECTS
+
+
+def context_agent_tool(agent: Agent, tool_name: str, tool_description: str, prepare):
+    # Like Agent.as_tool, but the shared agent is adapted to the run context (prepare) before every call
+    @function_tool(name_override=tool_name, description_override=tool_description)
+    async def run_agent(ctx: RunContextWrapper[AgentContext], input: str) -> str:
+        output = await Runner.run(
+            starting_agent=await prepare(agent, ctx.context),
+            input=input,
+            context=ctx.context,
+        )
+        return ItemHelpers.text_message_outputs(output.new_items)
+
+    return run_agent
+
+
+def print_exception(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        print(task.exception())
+
+
+def with_timeout(tool):
+    # Hosted tools (web search) run on the OpenAI side and are returned unchanged
+    if not isinstance(tool, FunctionTool):
+        return tool
+
+    seconds = TOOL_TIMEOUTS.get(tool.name, TOOL_TIMEOUT_DEFAULT)
+
+    async def on_invoke_tool(ctx: RunContextWrapper[AgentContext], input: str):
+        if tool.name not in TOOL_SIDE_EFFECTS:
+            try:
+                return await asyncio.wait_for(tool.on_invoke_tool(ctx, input), timeout=seconds)
+            except asyncio.TimeoutError:
+                await metrics.incr(f'tool_timeouts_{tool.name}')
+                return (f'Error: {tool.name} did not respond within {seconds} seconds. '
+                        f'Answer without it or try again later.')
+
+        # The call may already have had its effect (e.g. a sent transaction), so it is left to finish
+        task = asyncio.create_task(tool.on_invoke_tool(ctx, input))
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout=seconds)
+        except asyncio.TimeoutError:
+            task.add_done_callback(print_exception)
+            await metrics.incr(f'tool_timeouts_{tool.name}')
+            return (f'Error: {tool.name} did not finish within {seconds} seconds and is still running, its outcome '
+                    f'is unknown. Do not repeat the operation. Tell the user to check the result first '
+                    f'(wallet balance, task list) before retrying.')
+
+    return dataclasses.replace(tool, on_invoke_tool=on_invoke_tool)
+
+
+async def with_wallet(agent: Agent, context: AgentContext):
+    return agent.clone(mcp_servers=[await get_jupiter_server(private_key=context.private_key, user_id=context.user_id)])
+
+
+@function_tool
+async def search_knowledge_base(ctx: RunContextWrapper[AgentContext], query: str) -> str:
+    """Search through a knowledge base containing uploaded reference materials that are not publicly available on the Internet. Returns relevant passages with sources.
+
+    Args:
+        query: Search query describing the information needed.
+    """
+
+    if not ctx.context.knowledge_id:
+        return 'no relevant results'
+
+    results = await search_vector_store(client=ctx.context.client, vector_store_id=ctx.context.knowledge_id,
+                                        query=query)
+    if results:
+        ctx.context.sources.add('knowledge')
+    return format_passages(results) if results else 'no relevant results'
+
+
+@function_tool
+async def search_conversation_memory(ctx: RunContextWrapper[AgentContext], query: str) -> str:
+    """Search prior conversations and user-uploaded files. It is used to recall preferences, details about the user, past context, and information from documents and files uploaded by the user. Returns relevant passages with sources.
+
+    Args:
+        query: Search query describing the information needed.
+    """
+
+    if not ctx.context.user_memory_id:
+        return 'nothing relevant found'
+
+    results = await search_vector_store(client=ctx.context.client, vector_store_id=ctx.context.user_memory_id,
+                                        query=query)
+    if results:
+        ctx.context.sources.add('memory')
+    return format_passages(results) if results else 'nothing relevant found'
 
 
 @function_tool
-async def image_gen_tool(wrapper: RunContextWrapper, prompt: str) -> str:
+async def image_gen_tool(wrapper: RunContextWrapper[AgentContext], prompt: str) -> str:
     """The function generates an image at the user's request. A prompt must be provided to generate the image.
 
     Args:
         prompt: Prompt for image generation.
     """
 
-    client: AsyncOpenAI = wrapper.context[0]
+    client: AsyncOpenAI = wrapper.context.client
 
     img = await client.images.generate(
         model="gpt-image-1",
@@ -33,19 +129,19 @@ async def image_gen_tool(wrapper: RunContextWrapper, prompt: str) -> str:
     image_base64 = img.data[0].b64_json
     image_bytes = base64.b64decode(image_base64)
 
-    async with aiofiles.open(f"images/image_{wrapper.context[1]}.png", "wb") as f:
+    async with aiofiles.open(f"images/image_{wrapper.context.user_id}.png", "wb") as f:
         await f.write(image_bytes)
 
-    data = {'image': f"images/image_{wrapper.context[1]}.png", 'input_tokens': img.usage.input_tokens, 'output_tokens': img.usage.output_tokens}
+    data = {'image': f"images/image_{wrapper.context.user_id}.png", 'input_tokens': img.usage.input_tokens, 'output_tokens': img.usage.output_tokens}
 
-    await redis.set(f'image_{wrapper.context[1]}', json.dumps(data))
+    await redis.set(f'image_{wrapper.context.user_id}', json.dumps(data))
 
     return 'The image is generated'
 
 
 @function_tool
 async def create_task_tool(
-        ctx: RunContextWrapper,
+        ctx: RunContextWrapper[AgentContext],
         description: str,
         agent_message: str,
         schedule_type: Literal["once", "daily", "interval"],
@@ -74,10 +170,10 @@ async def create_task_tool(
     if schedule_type == "interval" and not interval_minutes:
         return "Error: interval in minutes must be specified for interval task"
 
-    user_repo: UserRepository = ctx.context[2]
-    scheduler: AsyncIOScheduler = ctx.context[3]
+    user_repo: UserRepository = ctx.context.user_repo
+    scheduler: AsyncIOScheduler = ctx.context.scheduler
 
-    task_id = await user_repo.add_task(user_id=ctx.context[1], description=description,
+    task_id = await user_repo.add_task(user_id=ctx.context.user_id, description=description,
                                        agent_message=agent_message, schedule_type=schedule_type,
                                        time_str=time_str, date_str=date_str, interval_minutes=interval_minutes)
 
@@ -91,8 +187,8 @@ async def create_task_tool(
             execute_task,
             'date',
             run_date=task_datetime,
-            args=[ctx.context[1], task_id],
-            id=f'{ctx.context[1]}_{task_id}'
+            args=[ctx.context.user_id, task_id],
+            id=f'{ctx.context.user_id}_{task_id}'
         )
 
     elif schedule_type == "daily":
@@ -103,8 +199,8 @@ async def create_task_tool(
             'cron',
             hour=task_time.hour,
             minute=task_time.minute,
-            args=[ctx.context[1], task_id],
-            id=f'{ctx.context[1]}_{task_id}'
+            args=[ctx.context.user_id, task_id],
+            id=f'{ctx.context.user_id}_{task_id}'
         )
 
     elif schedule_type == "interval":
@@ -112,8 +208,8 @@ async def create_task_tool(
             execute_task,
             'interval',
             minutes=interval_minutes,
-            args=[ctx.context[1], task_id],
-            id=f'{ctx.context[1]}_{task_id}'
+            args=[ctx.context.user_id, task_id],
+            id=f'{ctx.context.user_id}_{task_id}'
         )
 
     return f"✅ Task successfully created!\nID: {task_id}\nDescription: {description}\nSchedule: {schedule_type}"
@@ -121,7 +217,7 @@ async def create_task_tool(
 
 @function_tool
 async def list_tasks_tool(
-        ctx: RunContextWrapper,
+        ctx: RunContextWrapper[AgentContext],
 ) -> str:
     """Gets list of user tasks.
 
@@ -130,8 +226,8 @@ async def list_tasks_tool(
     Returns:
         List of tasks in text format
     """
-    user_repo: UserRepository = ctx.context[2]
-    tasks = await user_repo.get_all_tasks(user_id=ctx.context[1])
+    user_repo: UserRepository = ctx.context.user_repo
+    tasks = await user_repo.get_all_tasks(user_id=ctx.context.user_id)
 
     text_tasks = '\n'.join([f"Task ID[{task.id}]: {task.description}, {task.schedule_type}, "
                             f"{'active' if task.is_active else 'inactive'}, {task.time_str or task.date_str or task.interval_minutes}"
@@ -141,7 +237,7 @@ async def list_tasks_tool(
 
 @function_tool
 async def update_task_tool(
-        ctx: RunContextWrapper,
+        ctx: RunContextWrapper[AgentContext],
         task_id: int,
         description: Optional[str] = None,
         agent_message: Optional[str] = None,
@@ -166,10 +262,10 @@ async def update_task_tool(
     Returns:
         Message about update result
     """
-    user_repo: UserRepository = ctx.context[2]
-    scheduler: AsyncIOScheduler = ctx.context[3]
+    user_repo: UserRepository = ctx.context.user_repo
+    scheduler: AsyncIOScheduler = ctx.context.scheduler
 
-    task = await user_repo.get_task(ctx.context[1], task_id)
+    task = await user_repo.get_task(ctx.context.user_id, task_id)
     if not task:
         return '❌ Task not found'
 
@@ -181,12 +277,12 @@ async def update_task_tool(
     interval_minutes = interval_minutes or task.interval_minutes
     is_active = is_active or task.is_active
 
-    await user_repo.update_task(ctx.context[1], task_id, description=description,
+    await user_repo.update_task(ctx.context.user_id, task_id, description=description,
                                 agent_message=agent_message, is_active=is_active,
                                 schedule_type=schedule_type, time_str=time_str,
                                 date_str=date_str, interval_minutes=interval_minutes)
     try:
-        scheduler.remove_job(f'{ctx.context[1]}_{task_id}')
+        scheduler.remove_job(f'{ctx.context.user_id}_{task_id}')
     except:
         pass
 
@@ -200,8 +296,8 @@ async def update_task_tool(
             execute_task,
             'date',
             run_date=task_datetime,
-            args=[ctx.context[1], task_id],
-            id=f'{ctx.context[1]}_{task_id}'
+            args=[ctx.context.user_id, task_id],
+            id=f'{ctx.context.user_id}_{task_id}'
         )
 
     elif schedule_type == "daily":
@@ -212,8 +308,8 @@ async def update_task_tool(
             'cron',
             hour=task_time.hour,
             minute=task_time.minute,
-            args=[ctx.context[1], task_id],
-            id=f'{ctx.context[1]}_{task_id}'
+            args=[ctx.context.user_id, task_id],
+            id=f'{ctx.context.user_id}_{task_id}'
         )
 
     elif schedule_type == "interval":
@@ -221,14 +317,14 @@ async def update_task_tool(
             execute_task,
             'interval',
             minutes=interval_minutes,
-            args=[ctx.context[1], task_id],
-            id=f'{ctx.context[1]}_{task_id}'
+            args=[ctx.context.user_id, task_id],
+            id=f'{ctx.context.user_id}_{task_id}'
         )
 
 
 @function_tool
 async def delete_task_tool(
-        ctx: RunContextWrapper,
+        ctx: RunContextWrapper[AgentContext],
         task_id: int
 ) -> str:
     """Deletes task from scheduler.
@@ -240,12 +336,12 @@ async def delete_task_tool(
         Message about deletion result
     """
 
-    user_repo: UserRepository = ctx.context[2]
-    scheduler: AsyncIOScheduler = ctx.context[3]
-    await user_repo.delete_task(ctx.context[1], task_id)
+    user_repo: UserRepository = ctx.context.user_repo
+    scheduler: AsyncIOScheduler = ctx.context.scheduler
+    await user_repo.delete_task(ctx.context.user_id, task_id)
 
     try:
-        scheduler.remove_job(f'{ctx.context[1]}_{task_id}')
+        scheduler.remove_job(f'{ctx.context.user_id}_{task_id}')
     except:
         pass
 
@@ -255,7 +351,7 @@ async def delete_task_tool(
 
 @function_tool
 async def get_task_details_tool(
-        ctx: RunContextWrapper,
+        ctx: RunContextWrapper[AgentContext],
         task_id: int
 ) -> str:
     """Gets detailed task information.
@@ -267,9 +363,9 @@ async def get_task_details_tool(
         Detailed task information
     """
 
-    user_repo: UserRepository = ctx.context[2]
+    user_repo: UserRepository = ctx.context.user_repo
 
-    task = await user_repo.get_task(ctx.context[1], task_id)
+    task = await user_repo.get_task(ctx.context.user_id, task_id)
     if not task:
         return '❌ Task not found'
 
@@ -7,7 +7,7 @@ from aiogram_dialog.widgets.kbd import SwitchTo
 from bot.dialogs.i18n_widget import I18NFormat
 from bot.states.states import Menu
 from database.repositories.user import UserRepository
-from bot.utils.funcs_gpt import save_user_context_txt_file, delete_user_memory, create_vectore_store
+from bot.utils.funcs_gpt import save_user_context_txt_file, delete_user_memory, create_vectore_store, delete_chat_history
 
 
 async def on_cancel_menu(callback: ChatEvent, widget: Button, manager: DialogManager):
@@ -17,7 +17,7 @@ async def on_cancel_menu(callback: ChatEvent, widget: Button, manager: DialogMan
 async def on_approve_new(callback: ChatEvent, widget: Button, manager: DialogManager):
     user_repo: UserRepository = manager.middleware_data['user_repo']
     i18n = manager.middleware_data.get('i18n')
-    await user_repo.delete_chat_messages(manager.middleware_data['user'])
+    await delete_chat_history(user_repo, manager.middleware_data['user'])
 
     await callback.answer(text=i18n.get('command_approve_new_text'), show_alert=True)
     await callback.message.delete()
@@ -32,7 +32,7 @@ async def on_approve_save(callback: ChatEvent, widget: Button, manager: DialogMa
         await callback.answer(text=i18n.get('warning_save_context_txt'), show_alert=True)
         return
 
-    await user_repo.delete_chat_messages(manager.middleware_data['user'])
+    await delete_chat_history(user_repo, manager.middleware_data['user'])
 
     await callback.answer(text=i18n.get('command_save_approve_kb'), show_alert=True)
     await callback.message.delete()
@@ -44,7 +44,7 @@ async def on_approve_delete(callback: ChatEvent, widget: Button, manager: Dialog
 
     user_repo: UserRepository = manager.middleware_data['user_repo']
     await delete_user_memory(user_repo, manager.middleware_data['user'])
-    await user_repo.delete_chat_messages(manager.middleware_data['user'])
+    await delete_chat_history(user_repo, manager.middleware_data['user'])
     await create_vectore_store(user_repo, manager.middleware_data['user'])
 
     await callback.answer(text=i18n.get('command_delete_approve_text'), show_alert=True)
@@ -9,6 +9,7 @@ from aiogram_dialog import setup_dialogs
 from solana.rpc.async_api import AsyncClient
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.jobstores.base import JobLookupError
 
 from redis_service.connect import redis
 from I18N.factory import i18n_factory
@@ -18,6 +19,7 @@ from bot.middlewares.first_time import FirstTimeMiddleware
 from bot.routers.admin import router as admin_router
 from bot.routers.user import router as user_router
 from database.models import async_session, create_tables
+from database.repositories.utils import UtilsRepository
 from bot.dialogs.menu import dialog as menu_dialog
 from bot.dialogs.knowledge import dialog as knowledge_dialog
 from bot.dialogs.settings import dialog as settings_dialog
@@ -25,8 +27,9 @@ from bot.dialogs.wallet import dialog as wallet_dialog
 from bot.dialogs.balance import dialog as balance_dialog
 from bot.utils.check_burn_address import add_burn_address
 from bot.commands import set_commands
-from bot.scheduler_funcs.daily_tokens import add_daily_tokens
+from bot.scheduler_funcs.archive_messages import archive_messages
 from bot.agents_tools.mcp_servers import get_dexpapirka_server
+from bot.agents_tools.agents_ import build_main_agents
 from bot.utils.create_bot import bot
 from bot.utils.scheduler_provider import set_scheduler
 
@@ -54,12 +57,19 @@ async def main():
     set_scheduler(scheduler)
     scheduler.start()
 
-    if not scheduler.get_job('daily_tokens'):
-        scheduler.add_job(add_daily_tokens, trigger='cron', hour='0', minute='0', id='daily_tokens')
+    # Daily credits are refilled on the first request of the day, the midnight job is no longer used
+    try:
+        scheduler.remove_job('daily_tokens')
+    except JobLookupError:
+        pass
+
+    if not scheduler.get_job('archive_messages'):
+        scheduler.add_job(archive_messages, trigger='cron', hour='3', minute='0', id='archive_messages')
 
     print(scheduler.get_jobs())
 
     dexpaprika_server = await get_dexpapirka_server()
+    build_main_agents(mcp_server_1=dexpaprika_server)
 
     dp.startup.register(on_startup)
     await bot.delete_webhook(drop_pending_updates=True)
@@ -78,6 +88,8 @@ async def main():
 
 async def on_startup():
     await create_tables()
+    async with async_session() as session:
+        await UtilsRepository(session).convert_legacy_image_messages()
     await add_burn_address(bot=bot)
 
 
@@ -1,9 +1,11 @@
+from datetime import datetime, timezone
 from typing import Any, Awaitable, Callable, Dict, Optional
 
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, CallbackQuery
 from fluentogram import TranslatorHub
 
+from bot.utils.calculate_tokens import refill_daily_credits
 from config import CREDITS_ADMIN_DAILY, START_BALANCE, ADMIN_ID, ADMINS_LIST
 
 
@@ -37,7 +39,9 @@ class TranslatorRunnerMiddleware(BaseMiddleware):
                        else START_BALANCE
                        )
 
-        user = await user_repo.create_if_not_exists(telegram_id=from_user.id, balance_credits=sum_credits)
+        user = await user_repo.create_if_not_exists(telegram_id=from_user.id, balance_credits=sum_credits,
+                                                    last_refill_at=datetime.now(timezone.utc))
+        await refill_daily_credits(user_repo=user_repo, user=user)
 
         lang = user.language if user.language else 'en'
         ctx_data[self.translator_runner_alias] = translator_hub.get_translator_by_locale(lang)
@@ -6,6 +6,7 @@ from aiogram_dialog import DialogManager, StartMode
 
 from config import ADMIN_ID, ADMINS_LIST
 from database.repositories.utils import UtilsRepository
+from redis_service import metrics
 import bot.keyboards.inline as inline_kb
 from bot.states.states import Knowledge, Input, Wallet
 
@@ -43,4 +44,46 @@ async def cmd_knowledge(message: Message, utils_repo: UtilsRepository, i18n, dia
 @router.message(Command('wallet'), IsAdmin())
 async def cmd_wallet(message: Message, state: FSMContext, dialog_manager: DialogManager):
     await state.set_state(Input.main)
-    await dialog_manager.start(state=Wallet.main, mode=StartMode.RESET_STACK)
\ No newline at end of file
+    await dialog_manager.start(state=Wallet.main, mode=StartMode.RESET_STACK)
+
+
+@router.message(Command('stats'), IsAdmin())
+async def cmd_stats(message: Message, command: CommandObject, i18n):
+    # /stats or /stats YYYY-MM-DD
+    counters, gauges = await metrics.get_metrics(day=command.args.strip() if command.args else None)
+
+    lines = [f'{name}: {value}' for name, value in sorted(gauges.items())]
+    for name, value in sorted(counters.items()):
+        if name.endswith('_count'):
+            continue
+        if name.endswith('_sum'):
+            base = name[:-len('_sum')]
+            count = int(counters.get(f'{base}_count', 0))
+            lines.append(f'{base}: avg {float(value) / count if count else 0:.2f} ({count})')
+        else:
+            lines.append(f'{name}: {value}')
+
+    if int(counters.get('input_tokens', 0)):
+        lines.append(f"prompt_cache_hit_rate: "
+                     f"{int(counters.get('cached_input_tokens', 0)) / int(counters['input_tokens']):.1%}")
+
+    # Share of tool calls served by the tool caches, joined calls waited for an identical call in progress
+    for name in sorted(name[len('tool_cache_misses_'):] for name in counters if name.startswith('tool_cache_misses_')):
+        served = int(counters.get(f'tool_cache_hits_{name}', 0)) + int(counters.get(f'tool_cache_joined_{name}', 0))
+        lines.append(f"tool_cache_hit_rate_{name}: "
+                     f"{served / (served + int(counters[f'tool_cache_misses_{name}'])):.1%}")
+
+    # Light route savings, estimated against the average full route request of the same day
+    light = int(counters.get('route_light_seconds_count', 0))
+    full = int(counters.get('route_full_seconds_count', 0))
+    if light and full:
+        def average(name, count):
+            return float(counters.get(f'{name}_sum', 0)) / count
+
+        lines.append(f"light_route_savings: "
+                     f"{light * (average('route_full_input_tokens', full) - average('route_light_input_tokens', light)):.0f} "
+                     f"input tokens, "
+                     f"{light * (average('route_full_seconds', full) - average('route_light_seconds', light)):.0f} s")
+
+    await message.answer(text='\n'.join(lines) if lines else '-',
+                         reply_markup=inline_kb.close_text(i18n.get('close_kb')))
@@ -1,4 +1,3 @@
-import asyncio
 from io import BytesIO
 
 from redis.asyncio.client import Redis
@@ -14,7 +13,7 @@ from database.repositories.utils import UtilsRepository
 from database.models import User
 import bot.keyboards.inline as inline_kb
 from bot.states.states import Menu, Settings, Knowledge, Wallet, Input, Balance
-from bot.utils.send_answer import process_after_photo, process_after_text
+from bot.utils.request_queue import enqueue_request
 from bot.utils.funcs_gpt import transcribe_audio, add_file_to_memory
 from config import TYPE_USAGE, ADMIN_ID, ADMINS_LIST
 from bot.utils.check_payment import check_payment_sol, check_payment_ton
@@ -94,8 +93,6 @@ async def cmd_settings(message: Message, dialog_manager: DialogManager, state: F
 
 @router.message(F.text, StateFilter(None))
 async def text_input(message: Message, user_repo: UserRepository, utils_repo: UtilsRepository, redis: Redis, user: User, i18n, mcp_server, scheduler):
-    if await redis.get(f'request_{message.from_user.id}'):
-        return
     if TYPE_USAGE == 'private':
         if message.from_user.id != ADMIN_ID and message.from_user.id not in ADMINS_LIST:
             return
@@ -103,16 +100,13 @@ async def text_input(message: Message, user_repo: UserRepository, utils_repo: Ut
         if user.balance_credits <= 0:
             return await message.answer(i18n.get('warning_text_no_credits'))
 
-    await redis.set(f'request_{message.from_user.id}', 't', ex=40)
     mess_to_delete = await message.answer(text=i18n.get('wait_answer_text'))
-    task = asyncio.create_task(process_after_text(message=message, user=user, user_repo=user_repo, utils_repo=utils_repo,
-                                                  redis=redis, i18n=i18n, mess_to_delete=mess_to_delete, mcp_server_1=mcp_server, scheduler=scheduler))
+    await enqueue_request(kind='text', message=message, wait_message=mess_to_delete, mcp_server=mcp_server,
+                          scheduler=scheduler)
 
 
 @router.message(F.photo, StateFilter(None))
 async def photo_input(message: Message, user_repo: UserRepository, utils_repo: UserRepository, redis: Redis, user: User, i18n, mcp_server, scheduler):
-    if await redis.get(f'request_{message.from_user.id}'):
-        return
     if TYPE_USAGE == 'private':
         if message.from_user.id != ADMIN_ID and message.from_user.id not in ADMINS_LIST:
             return
@@ -120,16 +114,13 @@ async def photo_input(message: Message, user_repo: UserRepository, utils_repo: U
         if user.balance_credits <= 0:
             return await message.answer(i18n.get('warning_text_no_credits'))
 
-    await redis.set(f'request_{message.from_user.id}', 't', ex=40)
     mess_to_delete = await message.answer(text=i18n.get('wait_answer_text'))
-    task = asyncio.create_task(process_after_photo(message=message, user=user, user_repo=user_repo, utils_repo=utils_repo,
-                                                   redis=redis, i18n=i18n, mess_to_delete=mess_to_delete, mcp_server_1=mcp_server, scheduler=scheduler))
+    await enqueue_request(kind='photo', message=message, wait_message=mess_to_delete, mcp_server=mcp_server,
+                          scheduler=scheduler)
 
 
 @router.message(F.voice, StateFilter(None))
 async def input_voice(message: Message, user_repo: UserRepository, utils_repo: UserRepository, redis: Redis, user: User, i18n, mcp_server, scheduler):
-    if await redis.get(f'request_{message.from_user.id}'):
-        return
     if TYPE_USAGE == 'private':
         if message.from_user.id != ADMIN_ID and message.from_user.id not in ADMINS_LIST:
             return
@@ -137,7 +128,6 @@ async def input_voice(message: Message, user_repo: UserRepository, utils_repo: U
         if user.balance_credits <= 0:
             return await message.answer(i18n.get('warning_text_no_credits'))
 
-    await redis.set(f'request_{message.from_user.id}', 't', ex=40)
     mess_to_delete = await message.answer(text=i18n.get('wait_answer_text'))
     voice_id = message.voice.file_id
     file_path = await message.bot.get_file(file_id=voice_id)
@@ -146,19 +136,14 @@ async def input_voice(message: Message, user_repo: UserRepository, utils_repo: U
         text_from_voice = await transcribe_audio(bytes_audio=file_bytes)
     except Exception as e:
         await message.answer(text=i18n.get('warning_text_error'))
-        await redis.delete(f'request_{message.from_user.id}')
         return await mess_to_delete.delete()
 
-    task = asyncio.create_task(
-        process_after_text(message=message, user=user, user_repo=user_repo, utils_repo=utils_repo,
-                           redis=redis, i18n=i18n, mess_to_delete=mess_to_delete, text_from_voice=text_from_voice, mcp_server_1=mcp_server,
-                           scheduler=scheduler))
+    await enqueue_request(kind='text', message=message, wait_message=mess_to_delete, mcp_server=mcp_server,
+                          scheduler=scheduler, text=text_from_voice)
 
 
 @router.message(F.document, StateFilter(None))
 async def input_document(message: Message, user_repo: UserRepository, utils_repo: UserRepository, redis: Redis, user: User, i18n, mcp_server, scheduler):
-    if await redis.get(f'request_{message.from_user.id}'):
-        return
     if TYPE_USAGE == 'private':
         if message.from_user.id != ADMIN_ID and message.from_user.id not in ADMINS_LIST:
             return
@@ -170,7 +155,6 @@ async def input_document(message: Message, user_repo: UserRepository, utils_repo
     if format_doc not in DICT_FORMATS:
         return await message.answer(i18n.get('warning_text_format'))
 
-    await redis.set(f'request_{message.from_user.id}', 't', ex=40)
     mess_to_delete = await message.answer(text=i18n.get('wait_answer_text'))
     file_id = message.document.file_id
     file_path = await message.bot.get_file(file_id=file_id)
@@ -179,15 +163,11 @@ async def input_document(message: Message, user_repo: UserRepository, utils_repo
         await add_file_to_memory(user_repo=user_repo, user=user,
                                  file_name=message.document.file_name, file_bytes=file_bytes,
                                  mem_type=DICT_FORMATS.get(format_doc))
-        task = asyncio.create_task(
-            process_after_text(message=message, user=user, user_repo=user_repo, utils_repo=utils_repo,
-                               redis=redis, i18n=i18n, mess_to_delete=mess_to_delete, mcp_server_1=mcp_server,
-                               constant_text=i18n.get('text_user_upload_file', filename=message.document.file_name),
-                               scheduler=scheduler)
-        )
+        await enqueue_request(kind='text', message=message, wait_message=mess_to_delete, mcp_server=mcp_server,
+                              scheduler=scheduler,
+                              text=i18n.get('text_user_upload_file', filename=message.document.file_name))
     except Exception as e:
         await message.answer(i18n.get('warning_text_error'))
-        await redis.delete(f'request_{message.from_user.id}')
         await mess_to_delete.delete()
 
 
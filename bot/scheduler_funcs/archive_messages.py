@@ -0,0 +1,25 @@
+from datetime import datetime, timezone, timedelta
+
+from database.repositories.utils import UtilsRepository
+from database.models import async_session
+from bot.utils.funcs_gpt import delete_attachment_files
+from config import ARCHIVE_AFTER_DAYS, ARCHIVE_KEEP_MESSAGES, ARCHIVE_RETENTION_DAYS, ARCHIVE_BATCH_SIZE
+
+
+async def archive_messages():
+    now_utc = datetime.now(timezone.utc)
+    async with async_session() as session_:
+        utils_repo = UtilsRepository(session_)
+        ids = await utils_repo.get_archivable_message_ids(
+            older_than=now_utc - timedelta(days=ARCHIVE_AFTER_DAYS),
+            keep_messages=ARCHIVE_KEEP_MESSAGES
+        )
+        for start in range(0, len(ids), ARCHIVE_BATCH_SIZE):
+            try:
+                moved, attachments = await utils_repo.archive_chat_messages(ids[start:start + ARCHIVE_BATCH_SIZE])
+                await delete_attachment_files(attachments)
+            except Exception as e:
+                print(e)
+                await session_.rollback()
+
+        await utils_repo.purge_archived_messages(older_than=now_utc - timedelta(days=ARCHIVE_RETENTION_DAYS))
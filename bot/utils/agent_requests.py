@@ -1,5 +1,7 @@
-import base64, json, uuid
+import asyncio
+import json, uuid
 import os
+import time
 from io import BytesIO
 from typing import Optional
 
@@ -10,12 +12,21 @@ from aiogram.types import BufferedInputFile
 from redis.asyncio.client import Redis
 from agents import Runner, RunConfig
 from dataclasses import dataclass
+from openai import APIStatusError
 
-from bot.agents_tools.agents_ import client, create_main_agent, memory_creator_agent
+from bot.agents_tools.agents_ import client, get_main_agent, light_agent, memory_creator_agent, runtime_context
+from bot.agents_tools.context import AgentContext
 from database.models import User
 from database.repositories.user import UserRepository
 from database.repositories.utils import UtilsRepository
-from config import ADMIN_ID
+from bot.utils.file_search import prefetch_context, prefetch_message
+from bot.utils.tool_selection import select_tools, used_tools
+from bot.utils.answer_cache import find_answer, store_answer, is_shareable
+from bot.utils.message_router import is_small_talk, route_message, ROUTE_LIGHT, ROUTE_FULL
+from redis_service import metrics
+from config import (ADMIN_ID, HISTORY_TOKENS_LIMIT, USE_PREVIOUS_RESPONSE_ID, CHAIN_TOKENS_LIMIT, IMAGE_HISTORY_TURNS,
+                    PREFETCH_CONTEXT, PREFETCH_TIMEOUT, ROUTE_SMALL_TALK, ROUTER_HISTORY_TOKENS, TOOL_SELECTION,
+                    ANSWER_CACHE, SEMANTIC_CACHE)
 
 
 @dataclass
@@ -26,13 +37,16 @@ class AnswerText:
     input_tokens_image: int
     output_tokens: int
     output_tokens_image: int
+    answer_tokens: int
 
 @dataclass
 class AnswerImage:
     answer: str
     input_tokens: int
     output_tokens: int
+    answer_tokens: int
     image_path: str
+    file_id: str
 
 
 async def return_vectors(user_id: int, user_repo: UserRepository, utils_repo: UtilsRepository):
@@ -55,42 +69,224 @@ async def return_vectors(user_id: int, user_repo: UserRepository, utils_repo: Ut
     return vector_store_id, knowledge_id
 
 
-async def encode_image(image_path):
-    async with aiofiles.open(image_path, "rb") as image_file:
-        return base64.b64encode(await image_file.read()).decode("utf-8")
-
+async def upload_image(image_path: str, image_bytes: bytes = None, mime_type: str = 'image/jpeg'):
+    if not image_bytes:
+        async with aiofiles.open(image_path, "rb") as image_file:
+            image_bytes = await image_file.read()
 
-async def text_request(text: str, user: User, user_repo: UserRepository, utils_repo: UtilsRepository,
-                       redis: Redis, mcp_server_1: MCPServerStdio, bot: Bot, scheduler):
+    file = await client.files.create(
+        file=(os.path.basename(image_path), image_bytes, mime_type),
+        purpose="vision"
+    )
+    return file.id
+
+
+async def history_to_input(messages: list, user_id: int, user_repo: UserRepository):
+    # Attachments are uploaded to OpenAI once and referenced by file id afterwards.
+    # Images older than IMAGE_HISTORY_TURNS user turns are replaced with a text note instead of being resent.
+    recent_images = []
+    turns = 0
+    for message in reversed(messages):
+        if message.role != 'user':
+            continue
+        turns += 1
+        if turns > IMAGE_HISTORY_TURNS:
+            break
+        recent_images.extend(attachment for attachment in message.attachments if attachment.kind == 'image')
+
+    file_ids = {attachment.id: attachment.file_id for attachment in recent_images}
+    not_uploaded = [attachment for attachment in recent_images if not attachment.file_id]
+    uploaded = await asyncio.gather(*[upload_image(image_path=attachment.path, mime_type=attachment.mime_type)
+                                      for attachment in not_uploaded])
+    for attachment, file_id in zip(not_uploaded, uploaded):
+        await user_repo.set_attachment_file_id(user_id=user_id, attachment_id=attachment.id, file_id=file_id)
+        file_ids[attachment.id] = file_id
+
+    history = []
+    for message in messages:
+        images = [attachment for attachment in message.attachments if attachment.kind == 'image']
+        if not images:
+            history.append({'role': message.role, 'content': message.content})
+        elif all(image.id in file_ids for image in images):
+            history.append({'role': message.role,
+                            'content': [{"type": "input_text", "text": message.content}] +
+                                       [{"type": "input_image", "file_id": file_ids[image.id]} for image in images]})
+        else:
+            history.append({'role': message.role,
+                            'content': f"[The user sent an image earlier, it is no longer attached. "
+                                       f"Caption: {message.content}]"})
+
+    return history
+
+
+async def start_prefetch(query: str, knowledge_id: str, user_memory_id: str):
+    try:
+        passages = await asyncio.wait_for(prefetch_context(client=client, query=query, knowledge_id=knowledge_id,
+                                                           user_memory_id=user_memory_id), timeout=PREFETCH_TIMEOUT)
+        await metrics.incr('prefetch_hits' if passages else 'prefetch_misses')
+        return passages
+    except asyncio.TimeoutError:
+        await metrics.incr('prefetch_timeouts')
+    except Exception as e:
+        print(e)
+
+
+async def prefetched_messages(prefetch_task: Optional[asyncio.Task], context: AgentContext):
+    if not prefetch_task:
+        return []
+
+    passages = await prefetch_task
+    if not passages:
+        return []
+
+    context.sources.update(passages)
+    return [{'role': 'system', 'content': prefetch_message(passages)}]
+
+
+def message_text(message: dict):
+    if isinstance(message['content'], str):
+        return message['content']
+    return ' '.join(part['text'] for part in message['content'] if part['type'] == 'input_text')
+
+
+def cached_tokens(runner):
+    # Input tokens served from the OpenAI prompt cache
+    return sum(response.usage.input_tokens_details.cached_tokens for response in runner.raw_responses)
+
+
+async def run_agent(writer=None, **kwargs):
+    # Streams the text of every model response into the writer, a new response replaces the previous text
+    if not writer:
+        return await Runner.run(**kwargs)
+
+    runner = Runner.run_streamed(**kwargs)
+    async for event in runner.stream_events():
+        if event.type != 'raw_response_event':
+            continue
+        if event.data.type == 'response.created':
+            writer.reset()
+        elif event.data.type == 'response.output_text.delta':
+            await writer.push(event.data.delta)
+    return runner
+
+
+async def run_main_agent(new_message: dict, user: User, user_repo: UserRepository, utils_repo: UtilsRepository,
+                         redis: Redis, mcp_server_1: MCPServerStdio, scheduler, writer=None, query: str = None):
+    # query: text to search the knowledge base and memory for while the history is loading
     vector_store_id, knowledge_id = await return_vectors(user_id=user.telegram_id, user_repo=user_repo, utils_repo=utils_repo)
-    messages = await user_repo.get_messags(user_id=user.telegram_id)
+    prefetch_task = asyncio.create_task(start_prefetch(query=query, knowledge_id=knowledge_id,
+                                                       user_memory_id=vector_store_id)) \
+        if query and PREFETCH_CONTEXT else None
     user_wallet = await user_repo.get_wallet(user_id=user.telegram_id)
 
-    runner = await Runner.run(
-        starting_agent=await create_main_agent(user_memory_id=vector_store_id, knowledge_id=knowledge_id,
-                                         mcp_server_1=mcp_server_1, user_id=user.telegram_id,
-                                         private_key=user_wallet),
-        input=[{'role': message.role,
-                'content': message.content if f'image_{user.telegram_id}' not in message.content
-                else [{"type": "input_text", "text": message.content.split('|')[-1]},
-                {
-                    "type": "input_image",
-                    "image_url": f"data:image/jpeg;base64,{await encode_image(message.content.split('|')[0])}",
-                }]}
-               for message in messages] + [{'role': 'user', 'content': text}],
-
-        context=(client, user.telegram_id, user_repo, scheduler),
-        run_config=RunConfig(
-            tracing_disabled=False
+    main_agent = get_main_agent(mcp_server_1=mcp_server_1, wallet=bool(user_wallet))
+    if TOOL_SELECTION:
+        main_agent = await select_tools(agent=main_agent, client=client, user_id=user.telegram_id,
+                                        text=message_text(new_message), knowledge_id=knowledge_id)
+    context = AgentContext(client=client, user_id=user.telegram_id, user_repo=user_repo, scheduler=scheduler,
+                           knowledge_id=knowledge_id, user_memory_id=vector_store_id, private_key=user_wallet)
+    run_config = RunConfig(
+        tracing_disabled=False
+    )
+
+    context_message = {'role': 'system', 'content': runtime_context()}
+    runner = None
+    previous_response_id = (await user_repo.get_last_response_id(user_id=user.telegram_id)
+                            if USE_PREVIOUS_RESPONSE_ID else None)
+    if previous_response_id:
+        try:
+            runner = await run_agent(
+                writer=writer,
+                starting_agent=main_agent,
+                input=[context_message, *await prefetched_messages(prefetch_task, context), new_message],
+                previous_response_id=previous_response_id,
+                context=context,
+                run_config=run_config
+            )
+        except APIStatusError as e:
+            # The stored response expired or was deleted - replay the history instead
+            if e.param != 'previous_response_id':
+                raise
+            print(e)
+
+    if not runner:
+        messages = await user_repo.get_messages_window(user_id=user.telegram_id, max_tokens=HISTORY_TOKENS_LIMIT)
+        history = await history_to_input(messages=messages, user_id=user.telegram_id, user_repo=user_repo)
+        runner = await run_agent(
+            writer=writer,
+            starting_agent=main_agent,
+            input=history + [context_message, *await prefetched_messages(prefetch_task, context), new_message],
+            context=context,
+            run_config=run_config
         )
+
+    tools = used_tools(runner)
+    print(f'Tools: user {user.telegram_id}, {len(main_agent.tools)} offered, used {tools}')
+    await metrics.observe('tools_offered', len(main_agent.tools))
+    await metrics.observe('tools_used', len(tools))
+    for tool in tools:
+        await metrics.incr(f'tool_calls_{tool}')
+    await metrics.incr('input_tokens', sum(response.usage.input_tokens for response in runner.raw_responses))
+    await metrics.incr('cached_input_tokens', cached_tokens(runner))
+
+    if USE_PREVIOUS_RESPONSE_ID:
+        if runner.raw_responses[0].usage.input_tokens > CHAIN_TOKENS_LIMIT:
+            await user_repo.delete_last_response_id(user_id=user.telegram_id)
+        else:
+            await user_repo.set_last_response_id(user_id=user.telegram_id, response_id=runner.last_response_id)
+
+    return runner
+
+
+async def run_light_agent(new_message: dict, messages: list, writer=None):
+    # Small talk: no tools, no persona prompt, only the most recent part of the conversation
+    return await run_agent(
+        writer=writer,
+        starting_agent=light_agent,
+        input=[{'role': message.role, 'content': message.content} for message in messages] + [new_message],
+        run_config=RunConfig(tracing_disabled=False)
     )
 
+
+async def text_request(text: str, user: User, user_repo: UserRepository, utils_repo: UtilsRepository,
+                       redis: Redis, mcp_server_1: MCPServerStdio, bot: Bot, scheduler, writer=None):
+    started = time.monotonic()
+    new_message = {'role': 'user', 'content': text}
+    route = ROUTE_FULL
+    if ROUTE_SMALL_TALK and is_small_talk(text):
+        messages = await user_repo.get_messages_window(user_id=user.telegram_id, max_tokens=ROUTER_HISTORY_TOKENS)
+        route = route_message(text=text, messages=messages)
+
+    lookup = None
+    if route == ROUTE_FULL and (ANSWER_CACHE or SEMANTIC_CACHE) and is_shareable(text):
+        knowledge_vector = await utils_repo.get_knowledge_vectore_store_id()
+        cached, lookup = await find_answer(client=client, text=text,
+                                           knowledge_id=knowledge_vector.id_vector if knowledge_vector else None)
+        if cached:
+            elapsed = time.monotonic() - started
+            print(f'Route {lookup.hit}: user {user.telegram_id}, {elapsed:.2f}s')
+            await metrics.observe(f'route_{lookup.hit}_seconds', elapsed)
+            return AnswerText(answer=cached['answer'], image_bytes=None, input_tokens=0, input_tokens_image=0,
+                              output_tokens=0, output_tokens_image=0, answer_tokens=cached['answer_tokens'])
+
+    if route == ROUTE_LIGHT:
+        runner = await run_light_agent(new_message=new_message, messages=messages, writer=writer)
+    else:
+        runner = await run_main_agent(new_message=new_message, user=user, user_repo=user_repo,
+                                      utils_repo=utils_repo, redis=redis, mcp_server_1=mcp_server_1,
+                                      scheduler=scheduler, writer=writer, query=text)
+
     input_tokens = 0
     output_tokens = 0
     for response in runner.raw_responses:
         input_tokens += response.usage.input_tokens
         output_tokens += response.usage.output_tokens
 
+    elapsed = time.monotonic() - started
+    print(f'Route {route}: user {user.telegram_id}, {elapsed:.2f}s, {input_tokens} input / {output_tokens} output tokens')
+    await metrics.observe(f'route_{route}_seconds', elapsed)
+    await metrics.observe(f'route_{route}_input_tokens', input_tokens)
+
     # await send_raw_response(bot, str(runner.raw_responses))
 
     answer = runner.final_output
@@ -109,47 +305,36 @@ async def text_request(text: str, user: User, user_repo: UserRepository, utils_r
             image_bytes = await image_file.read()
         os.remove(image_path)
         return AnswerText(answer=answer, image_bytes=image_bytes, input_tokens=input_tokens,
-                          input_tokens_image=input_tokens_image, output_tokens=output_tokens, output_tokens_image=output_tokens_image)
+                          input_tokens_image=input_tokens_image, output_tokens=output_tokens, output_tokens_image=output_tokens_image,
+                          answer_tokens=runner.raw_responses[-1].usage.output_tokens)
+
+    if lookup:
+        await store_answer(lookup=lookup, runner=runner, text=text, agent=get_main_agent(mcp_server_1=mcp_server_1),
+                           client=client)
 
     return AnswerText(answer=answer, image_bytes=None, input_tokens=input_tokens,
-                      input_tokens_image=0, output_tokens=output_tokens, output_tokens_image=0)
+                      input_tokens_image=0, output_tokens=output_tokens, output_tokens_image=0,
+                      answer_tokens=runner.raw_responses[-1].usage.output_tokens)
 
 
 async def image_request(image_bytes: bytes, user: User, user_repo: UserRepository,
                         utils_repo: UtilsRepository, redis: Redis, mcp_server_1: MCPServerStdio, bot: Bot,
                         scheduler, caption: str = None):
 
-    vector_store_id, knowledge_id = await return_vectors(user_id=user.telegram_id, user_repo=user_repo, utils_repo=utils_repo)
-    messages = await user_repo.get_messags(user_id=user.telegram_id)
-    user_wallet = await user_repo.get_wallet(user_id=user.telegram_id)
-
     id_image = uuid.uuid4()
-    async with aiofiles.open(f"images/image_{user.telegram_id}_{id_image}.jpeg", "wb") as image_file:
+    image_path = f"images/image_{user.telegram_id}_{id_image}.jpeg"
+    async with aiofiles.open(image_path, "wb") as image_file:
         await image_file.write(image_bytes)
+    file_id = await upload_image(image_path=image_path, image_bytes=image_bytes)
 
-    runner = await Runner.run(
-        starting_agent=await create_main_agent(user_memory_id=vector_store_id, knowledge_id=knowledge_id,
-                                         mcp_server_1=mcp_server_1, user_id=user.telegram_id,
-                                         private_key=user_wallet),
-        input=[{'role': message.role,
-                'content': message.content if f'image_{user.telegram_id}' not in message.content
-                else [{"type": "input_text", "text": message.content.split('|')[-1]},
-                      {
-                          "type": "input_image",
-                          "image_url": f"data:image/jpeg;base64,{await encode_image(message.content.split('|')[0])}",
-                      }]}
-               for message in messages] + [{'role': 'user', 'content': [{"type": "input_text",
-                                                                         "text": f"{caption if caption else '.'}"},
-                      {
-                          "type": "input_image",
-                          "image_url": f"data:image/jpeg;base64,{base64.b64encode(image_bytes).decode('utf-8')}",
-                      }]}],
-
-        context=(client, user.telegram_id, user_repo, scheduler),
-        run_config=RunConfig(
-            tracing_disabled=False
-        )
-    )
+    runner = await run_main_agent(new_message={'role': 'user', 'content': [{"type": "input_text",
+                                                                            "text": f"{caption if caption else '.'}"},
+                                                                           {
+                                                                               "type": "input_image",
+                                                                               "file_id": file_id,
+                                                                           }]},
+                                  user=user, user_repo=user_repo, utils_repo=utils_repo, redis=redis,
+                                  mcp_server_1=mcp_server_1, scheduler=scheduler)
 
     # await send_raw_response(bot, str(runner.raw_responses))
 
@@ -162,7 +347,8 @@ async def image_request(image_bytes: bytes, user: User, user_repo: UserRepositor
     answer = runner.final_output
 
     return AnswerImage(answer=answer, input_tokens=input_tokens,
-                       output_tokens=output_tokens, image_path=f'images/image_{user.telegram_id}_{id_image}.jpeg')
+                       output_tokens=output_tokens, answer_tokens=runner.raw_responses[-1].usage.output_tokens,
+                       image_path=image_path, file_id=file_id)
 
 
 async def send_raw_response(bot: Bot, raw_response: str):
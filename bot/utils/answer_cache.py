@@ -0,0 +1,166 @@
+import asyncio
+import hashlib
+import re
+import unicodedata
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from agents import Agent, Runner
+from openai import AsyncOpenAI
+
+from bot.agents_tools.context import AgentContext
+from bot.utils.tool_selection import used_tools, knowledge_has_files
+from bot.utils.semantic_cache import semantic_cache, embed, text_script
+from bot.utils.run_scheduler import run_scheduler, PRIORITY_TASK
+from redis_service import cache, metrics
+from config import ANSWER_CACHE, SEMANTIC_CACHE, SEMANTIC_CACHE_ROUTES, SEMANTIC_CACHE_MAX_CHARS
+
+# Words that tie a question to the user, their files or the conversation so far
+PERSONAL_PATTERN = re.compile(
+    r'\b(me|my|mine|myself|our|us|you said|remember|earlier|previous|above|before|again|'
+    r'this|that|these|those|it|file|document|upload|'
+    r'я|меня|мне|мной|мой|моя|моё|мое|мои|моих|мы|нас|нам|наш|наша|наши|помнишь|ранее|раньше|выше|снова|опять|'
+    r'это|этот|эта|эти|тот|та|те|он|она|оно|они|файл|документ)\b')
+
+
+# Questions about the current moment, their answers go stale as soon as they are written
+TIME_PATTERN = re.compile(
+    r'\b(today|tonight|tomorrow|yesterday|now|current|currently|latest|recent|recently|newest|new|news|date|time|'
+    r'week|month|year|weather|price|prices|rate|rates|'
+    r'сегодня|сегодняшн\w*|завтра|вчера|сейчас|текущ\w*|последн\w*|свеж\w*|нов\w*|дата|дату|время|час|'
+    r'недел\w*|месяц\w*|год\w*|погод\w*|цен\w*|курс\w*)\b')
+
+
+def normalize_question(text: str):
+    text = unicodedata.normalize('NFKC', text).lower()
+    return ' '.join(re.findall(r'\w+', text))
+
+
+def is_personal(text: str):
+    # Messages from the task scheduler and very short follow-ups ("why?", "and then?") depend on context too
+    normalized = normalize_question(text)
+    return (text.startswith('<msg from Task Scheduler>') or len(normalized.split()) < 3 or
+            bool(PERSONAL_PATTERN.search(normalized)))
+
+
+def is_time_sensitive(text: str):
+    return bool(TIME_PATTERN.search(normalize_question(text)))
+
+
+def is_shareable(text: str):
+    # Only questions whose answer does not depend on the user or on the moment are answered from the caches
+    return not is_personal(text) and not is_time_sensitive(text)
+
+
+def answer_key(text: str, knowledge_id: str, knowledge_version: int):
+    question = hashlib.sha256(normalize_question(text).encode()).hexdigest()
+    return f'answer_{knowledge_id}_{knowledge_version}_{question}'
+
+
+def answer_route(runner):
+    # 'general' - answered without tools, 'knowledge' - from knowledge base passages only,
+    # 'web' - from web search only, None - anything else (memory, scheduler, images...)
+    context: AgentContext = runner.context_wrapper.context
+    tools = set(used_tools(runner))
+    if not tools and not context.sources:
+        return 'general'
+    if context.sources == {'knowledge'} and tools <= {'search_knowledge_base'}:
+        return 'knowledge'
+    if not context.sources and tools == {'web_search_call'}:
+        return 'web'
+    return None
+
+
+@dataclass
+class CacheLookup:
+    knowledge_version: int
+    knowledge_id: Optional[str] = None
+    key: Optional[str] = None
+    semantic: bool = False
+    vector: Optional[np.ndarray] = None
+    script: Optional[str] = None
+    hit: Optional[str] = None
+
+
+async def find_answer(client: AsyncOpenAI, text: str, knowledge_id: Optional[str]):
+    # Exact answer cache first, then the semantic cache. Returns the cached answer (or None) and the lookup
+    # that store_answer needs to cache the answer of the run
+    lookup = CacheLookup(knowledge_version=await cache.knowledge_version(), knowledge_id=knowledge_id)
+    if ANSWER_CACHE and knowledge_id:
+        lookup.key = answer_key(text=text, knowledge_id=knowledge_id, knowledge_version=lookup.knowledge_version)
+        cached = await cache.get_answer(lookup.key)
+        await metrics.incr('answer_cache_hits' if cached else 'answer_cache_misses')
+        if cached:
+            lookup.hit = 'cache'
+            return cached, lookup
+
+    lookup.semantic = SEMANTIC_CACHE and len(text) <= SEMANTIC_CACHE_MAX_CHARS
+    if lookup.semantic:
+        # The embedding is a round trip before the run, it is only requested when an entry can match.
+        # Otherwise it is computed in the background when the shared answer is stored
+        try:
+            if not semantic_cache.entries or (set(SEMANTIC_CACHE_ROUTES) <= {'knowledge'} and
+                                              not await knowledge_has_files(client, knowledge_id)):
+                await metrics.incr('semantic_cache_misses')
+                return None, lookup
+            lookup.vector = await embed(client=client, text=text)
+        except Exception as e:
+            print(e)
+            return None, lookup
+
+        lookup.script = text_script(text)
+        cached = semantic_cache.search(vector=lookup.vector, script=lookup.script,
+                                       knowledge_version=lookup.knowledge_version)
+        await metrics.incr('semantic_cache_hits' if cached else 'semantic_cache_misses')
+        if cached:
+            lookup.hit = 'semantic_cache'
+            return cached, lookup
+
+    return None, lookup
+
+
+# Questions whose shared answer is being generated in this process
+regenerating: set[str] = set()
+
+
+async def store_answer(lookup: CacheLookup, runner, text: str, agent: Agent, client: AsyncOpenAI):
+    # The user's own answer is never cached: it was written with their history and runtime context in the prompt.
+    # When the run looks cacheable, the answer is generated again in the background from the question alone
+    route = answer_route(runner)
+    if not (lookup.key and route == 'knowledge') and not (lookup.semantic and route in SEMANTIC_CACHE_ROUTES):
+        return
+
+    question = normalize_question(text)
+    if question in regenerating:
+        return
+    regenerating.add(question)
+    asyncio.create_task(store_shared_answer(lookup=lookup, text=text, agent=agent, client=client, question=question))
+
+
+async def store_shared_answer(lookup: CacheLookup, text: str, agent: Agent, client: AsyncOpenAI, question: str):
+    try:
+        # Only the knowledge base tool, no history, no runtime context, no user data in the run context
+        shared_agent = agent.clone(tools=[tool for tool in agent.tools if tool.name == 'search_knowledge_base'])
+        context = AgentContext(client=client, user_id=0, user_repo=None, scheduler=None,
+                               knowledge_id=lookup.knowledge_id)
+        async with run_scheduler.slot(priority=PRIORITY_TASK):
+            runner = await Runner.run(starting_agent=shared_agent, input=[{'role': 'user', 'content': text}],
+                                      context=context)
+
+        route = answer_route(runner)
+        answer = {'answer': runner.final_output, 'answer_tokens': runner.raw_responses[-1].usage.output_tokens}
+        if lookup.key and route == 'knowledge':
+            await cache.set_answer(lookup.key, answer)
+        if lookup.semantic and route in SEMANTIC_CACHE_ROUTES:
+            if lookup.vector is None:
+                lookup.vector = await embed(client=client, text=text)
+                lookup.script = text_script(text)
+            semantic_cache.add(vector=lookup.vector, entry={
+                **answer, 'route': route, 'script': lookup.script,
+                'knowledge_version': lookup.knowledge_version if route == 'knowledge' else None})
+        await metrics.incr('shared_answers_generated')
+    except Exception as e:
+        print(e)
+    finally:
+        regenerating.discard(question)
@@ -1,7 +1,8 @@
 from database.models import User
 from database.repositories.user import UserRepository
 
-from config import TYPE_USAGE, CREDITS_INPUT_TEXT, CREDITS_OUTPUT_TEXT, CREDITS_INPUT_IMAGE, CREDITS_OUTPUT_IMAGE
+from config import (TYPE_USAGE, CREDITS_INPUT_TEXT, CREDITS_OUTPUT_TEXT, CREDITS_INPUT_IMAGE, CREDITS_OUTPUT_IMAGE,
+                    TOKENS_PER_IMAGE, CREDITS_USER_DAILY, CREDITS_ADMIN_DAILY, ADMIN_ID, ADMINS_LIST)
 
 
 async def calculate_tokens(user_repo: UserRepository, user: User,
@@ -15,4 +16,23 @@ async def calculate_tokens(user_repo: UserRepository, user: User,
         credits_output_img = (output_tokens_img / 1000) * CREDITS_OUTPUT_IMAGE
 
         credits = credits_input_text + credits_output_text + credits_input_img + credits_output_img
-        await user_repo.update(user, balance_credits=credits)
\ No newline at end of file
+        # Answers served from the cache cost nothing
+        if not credits:
+            return
+        await user_repo.debit_credits(user_id=user.telegram_id, credits=credits,
+                                      input_tokens=input_tokens_text + input_tokens_img,
+                                      output_tokens=output_tokens_text + output_tokens_img)
+
+
+async def refill_daily_credits(user_repo: UserRepository, user: User):
+    if TYPE_USAGE != 'private':
+        daily_credits = (CREDITS_ADMIN_DAILY
+                         if user.telegram_id == ADMIN_ID or user.telegram_id in ADMINS_LIST
+                         else CREDITS_USER_DAILY
+                         )
+        await user_repo.refill_credits(user=user, daily_credits=daily_credits)
+
+
+def estimate_tokens(text: str, images: int = 0) -> int:
+    # Rough estimate (~4 characters per token), stored once per message so history can be trimmed in SQL
+    return len(text or '') // 4 + 1 + images * TOKENS_PER_IMAGE
@@ -1,4 +1,3 @@
-import asyncio
 from datetime import datetime
 
 from agents import set_tracing_disabled
@@ -11,10 +10,10 @@ from redis_service.connect import redis
 from I18N.factory import i18n_factory
 from bot.agents_tools.mcp_servers import get_dexpapirka_server
 from bot.utils.scheduler_provider import get_scheduler
+from bot.utils.calculate_tokens import refill_daily_credits
+from bot.utils.run_scheduler import run_scheduler, PRIORITY_TASK
 
 set_tracing_disabled(False)
-CONCURRENCY_LIMIT = 10
-sem = asyncio.Semaphore(CONCURRENCY_LIMIT)
 
 translator_hub = i18n_factory()
 
@@ -23,11 +22,12 @@ async def execute_task(user_id: int, task_id: int):
     from bot.utils.send_answer import process_after_text
 
     scheduler = get_scheduler()
-    async with sem:
+    async with run_scheduler.slot(priority=PRIORITY_TASK):
         async with async_session() as session:
             user_repository = UserRepository(session)
             utils_repo = UtilsRepository(session)
             user = await user_repository.get_by_telegram_id(user_id)
+            await refill_daily_credits(user_repo=user_repository, user=user)
             user_task = await user_repository.get_task(user_id=user_id, task_id=task_id)
             i18n = translator_hub.get_translator_by_locale(user.language)
             mess_to_delete = await bot.send_message(chat_id=user_id, text=i18n.get('wait_answer_text_scheduler'))
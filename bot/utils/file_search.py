@@ -0,0 +1,50 @@
+import asyncio
+
+from openai import AsyncOpenAI
+
+from config import (FILE_SEARCH_MAX_RESULTS, FILE_SEARCH_PASSAGE_CHARS, PREFETCH_MAX_RESULTS,
+                    PREFETCH_SCORE_THRESHOLD)
+
+
+async def search_vector_store(client: AsyncOpenAI, vector_store_id: str, query: str,
+                              max_results: int = FILE_SEARCH_MAX_RESULTS):
+    page = await client.vector_stores.search(vector_store_id, query=query, max_num_results=max_results)
+    return page.data
+
+
+def format_passages(results) -> str:
+    # Ranked passages with their source file, each cut to FILE_SEARCH_PASSAGE_CHARS characters
+    passages = []
+    for number, result in enumerate(results, start=1):
+        text = '\n'.join(content.text for content in result.content if content.type == 'text').strip()
+        if len(text) > FILE_SEARCH_PASSAGE_CHARS:
+            text = text[:FILE_SEARCH_PASSAGE_CHARS].rstrip() + '…'
+        passages.append(f'[{number}] source: {result.filename} (file id: {result.file_id}, '
+                        f'score: {result.score:.2f})\n{text}')
+
+    return '\n\n'.join(passages)
+
+
+SOURCE_NAMES = {'knowledge': 'Knowledge base', 'memory': 'Conversation memory'}
+
+
+async def prefetch_context(client: AsyncOpenAI, query: str, knowledge_id: str, user_memory_id: str):
+    # Formatted passages by source ('knowledge', 'memory'), sources with nothing above PREFETCH_SCORE_THRESHOLD are left out
+    sources = {'knowledge': knowledge_id, 'memory': user_memory_id}
+    sources = {source: vector_store_id for source, vector_store_id in sources.items() if vector_store_id}
+    searches = await asyncio.gather(*[search_vector_store(client=client, vector_store_id=vector_store_id, query=query,
+                                                          max_results=PREFETCH_MAX_RESULTS)
+                                      for vector_store_id in sources.values()])
+
+    passages = {}
+    for source, results in zip(sources, searches):
+        results = [result for result in results if result.score >= PREFETCH_SCORE_THRESHOLD]
+        if results:
+            passages[source] = format_passages(results)
+    return passages
+
+
+def prefetch_message(passages: dict):
+    return ('PREFETCHED CONTEXT: passages found for the user\'s message ahead of time. If they answer the question, '
+            'use them directly instead of calling search_knowledge_base or search_conversation_memory.\n\n' +
+            '\n\n'.join(f'{SOURCE_NAMES[source]}:\n{text}' for source, text in passages.items()))
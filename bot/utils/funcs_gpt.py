@@ -2,11 +2,15 @@ import os
 from io import BytesIO
 
 from agents import Runner, RunConfig
+from redis.asyncio.client import Redis
 
-from bot.agents_tools.agents_ import client, create_main_agent, memory_creator_agent
-from database.models import User
+from bot.agents_tools.agents_ import client, memory_creator_agent
+from bot.utils.calculate_tokens import estimate_tokens
+from database.models import User, async_session
 from database.repositories.user import UserRepository
 from database.repositories.utils import UtilsRepository
+from redis_service import cache
+from config import SUMMARY_TRIGGER_TOKENS, SUMMARY_KEEP_MESSAGES
 
 
 async def file_to_context(utils_repo: UtilsRepository, file_name: str, file_bytes: bytes, mem_type: str):
@@ -35,6 +39,8 @@ async def file_to_context(utils_repo: UtilsRepository, file_name: str, file_byte
             order='desc'
         ):
             if file_.id == file.id and file_.status == 'completed':
+                await cache.invalidate(f'knowledge_files_{vector_store_id}')
+                await cache.invalidate_answers()
                 return True
             if file_.id == file.id and file_.status == 'failed':
                 return False
@@ -52,6 +58,7 @@ async def delete_knowledge_base(utils_repo: UtilsRepository):
     vector_store = await client.vector_stores.create(name="knowledge_base")
     await utils_repo.delete_knowledge_vectore_store_id()
     await utils_repo.add_knowledge_vectore_store_id(vector_store.id)
+    await cache.invalidate_answers()
 
 
 async def save_user_context_txt_file(user_repo: UserRepository, user: User):
@@ -99,6 +106,60 @@ async def save_user_context_txt_file(user_repo: UserRepository, user: User):
                 return False
 
 
+async def fold_user_context(user_id: int, redis: Redis):
+    # Runs in the background after an answer is sent: folds the oldest messages (and the previous summary)
+    # into one summary message, keeping the newest SUMMARY_KEEP_MESSAGES verbatim
+    if not await redis.set(f'summary_{user_id}', 't', nx=True, ex=300):
+        return
+
+    try:
+        async with async_session() as session:
+            user_repo = UserRepository(session)
+            if await user_repo.get_context_tokens(user_id=user_id) <= SUMMARY_TRIGGER_TOKENS:
+                return
+
+            messages = (await user_repo.get_messags(user_id=user_id))[:-SUMMARY_KEEP_MESSAGES]
+            if len(messages) < 2:
+                return
+
+            runner = await Runner.run(
+                starting_agent=memory_creator_agent,
+                input=[{'role': message.role,
+                        'content': f'[image] {message.content}' if message.attachments else message.content}
+                       for message in messages],
+                run_config=RunConfig(
+                    tracing_disabled=False
+                )
+            )
+
+            summary = f'Summary of the earlier conversation:\n{runner.final_output}'
+            attachments = await user_repo.get_attachments(user_id=user_id, last_message_id=messages[-1].id)
+            await user_repo.fold_messages(user_id=user_id, last_id=messages[-1].id,
+                                          summary=summary, tokens=estimate_tokens(summary))
+            await delete_attachment_files(attachments)
+    except Exception as e:
+        print(e)
+    finally:
+        await redis.delete(f'summary_{user_id}')
+
+
+async def delete_attachment_files(attachments: list):
+    for attachment in attachments:
+        try:
+            if attachment.file_id:
+                await client.files.delete(attachment.file_id)
+            if attachment.path and os.path.exists(attachment.path):
+                os.remove(attachment.path)
+        except Exception as e:
+            print(e)
+
+
+async def delete_chat_history(user_repo: UserRepository, user: User):
+    attachments = await user_repo.get_attachments(user_id=user.telegram_id)
+    await user_repo.delete_chat_messages(user)
+    await delete_attachment_files(attachments)
+
+
 async def delete_user_memory(user_repo: UserRepository, user: User):
     memory_vector = await user_repo.get_memory_vector(user_id=user.telegram_id)
     if memory_vector:
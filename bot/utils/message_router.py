@@ -0,0 +1,37 @@
+import re
+
+from config import ROUTER_MAX_WORDS
+
+ROUTE_LIGHT = 'light'
+ROUTE_FULL = 'full'
+
+# Greetings, thanks and acknowledgements in the supported languages. Yes/no and "do it" style answers are
+# deliberately missing: they may confirm an action the main agent has proposed
+SMALL_TALK_WORDS = {
+    'hi', 'hello', 'hey', 'yo', 'sup', 'morning', 'evening', 'night', 'good', 'day', 'gm', 'gn',
+    'thanks', 'thank', 'you', 'thx', 'ty', 'tnx', 'cheers', 'appreciate', 'it', 'much', 'so', 'a', 'lot', 'very',
+    'ok', 'okay', 'k', 'cool', 'nice', 'great', 'awesome', 'perfect', 'wow', 'lol', 'haha', 'got',
+    'bye', 'goodbye', 'see', 'later', 'cya', 'evi', 'dear',
+    'привет', 'приветик', 'здравствуй', 'здравствуйте', 'хай', 'добрый', 'доброе', 'доброй', 'утро', 'утра',
+    'день', 'вечер', 'ночи', 'спасибо', 'спс', 'благодарю', 'большое', 'огромное', 'тебе', 'вам',
+    'ок', 'окей', 'хорошо', 'понятно', 'ясно', 'отлично', 'круто', 'класс', 'супер', 'ого', 'пока', 'ахах',
+    'хаха', 'эви',
+}
+
+WORD_PATTERN = re.compile(r'\w+')
+
+
+def is_small_talk(text: str):
+    if not text or len(text) > ROUTER_MAX_WORDS * 12 or re.search(r'https?://|[/@#`]|\d', text):
+        return False
+
+    words = WORD_PATTERN.findall(text.lower())
+    return len(words) <= ROUTER_MAX_WORDS and all(word in SMALL_TALK_WORDS for word in words)
+
+
+def route_message(text: str, messages: list):
+    # messages: recent history. A reply to a question from the assistant is a real answer, not small talk
+    last_answer = next((message.content for message in reversed(messages) if message.role == 'assistant'), '')
+    if is_small_talk(text) and not last_answer.rstrip().endswith('?'):
+        return ROUTE_LIGHT
+    return ROUTE_FULL
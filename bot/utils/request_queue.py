@@ -0,0 +1,157 @@
+import asyncio
+import json
+import uuid
+
+from agents.mcp import MCPServerStdio
+from aiogram.types import Message
+
+from bot.utils.create_bot import bot
+from bot.utils.run_scheduler import run_scheduler, user_priority, RunQueueFull
+from database.models import async_session
+from database.repositories.user import UserRepository
+from database.repositories.utils import UtilsRepository
+from redis_service.connect import redis
+from I18N.factory import i18n_factory
+from redis_service import metrics
+from config import REQUEST_LEASE_SECONDS
+
+# Incoming messages are pushed to a per-user FIFO (queue_{id}). The first message starts a worker that holds
+# the lease request_{id} for as long as the queue is not empty, extending it while an agent run is in progress.
+# The first message is answered right away, text messages that arrive during a run are answered together by
+# the next run. A batch is removed from the queue only after it has been processed.
+
+RELEASE_LEASE = redis.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+EXTEND_LEASE = redis.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+translator_hub = i18n_factory()
+
+
+async def enqueue_request(kind: str, message: Message, wait_message: Message, mcp_server: MCPServerStdio,
+                          scheduler, text: str = None):
+    # kind is 'text' (text, transcribed voice, uploaded document) or 'photo'
+    user_id = message.from_user.id
+    item = {'kind': kind, 'text': text if text else message.text,
+            'message': message.model_dump_json(exclude_none=True),
+            'wait_message': wait_message.model_dump_json(exclude_none=True)}
+    await redis.rpush(f'queue_{user_id}', json.dumps(item))
+
+    token = uuid.uuid4().hex
+    if await redis.set(f'request_{user_id}', token, nx=True, ex=REQUEST_LEASE_SECONDS):
+        asyncio.create_task(run_queue(user_id=user_id, token=token, mcp_server=mcp_server, scheduler=scheduler))
+
+
+async def heartbeat(user_id: int, token: str):
+    while await EXTEND_LEASE(keys=[f'request_{user_id}'], args=[token, REQUEST_LEASE_SECONDS]):
+        await asyncio.sleep(REQUEST_LEASE_SECONDS / 3)
+    print(f'Request lease of user {user_id} expired')
+
+
+async def next_batch(user_id: int):
+    # Either one photo or all text messages at the head of the queue, left in the queue until trimmed by run_queue
+    items = [json.loads(item) for item in await redis.lrange(f'queue_{user_id}', 0, -1)]
+    if not items:
+        return []
+
+    batch = items[:1]
+    if batch[0]['kind'] == 'text':
+        for item in items[1:]:
+            if item['kind'] != 'text':
+                break
+            batch.append(item)
+
+    return batch
+
+
+async def run_queue(user_id: int, token: str, mcp_server: MCPServerStdio, scheduler):
+    heartbeat_task = asyncio.create_task(heartbeat(user_id=user_id, token=token))
+    try:
+        while True:
+            batch = await next_batch(user_id=user_id)
+            if batch:
+                try:
+                    await process_batch(user_id=user_id, batch=batch, mcp_server=mcp_server, scheduler=scheduler)
+                except Exception as e:
+                    # A failing batch is dropped so the messages queued after it are still answered
+                    print(f'Request batch of user {user_id} failed: {e}')
+                    await metrics.incr('request_batch_errors')
+                finally:
+                    await redis.ltrim(f'queue_{user_id}', len(batch), -1)
+                continue
+
+            heartbeat_task.cancel()
+            await RELEASE_LEASE(keys=[f'request_{user_id}'], args=[token])
+            # A message pushed between the last check and the release found the lease still taken
+            if not await redis.llen(f'queue_{user_id}') or \
+                    not await redis.set(f'request_{user_id}', token, nx=True, ex=REQUEST_LEASE_SECONDS):
+                break
+            heartbeat_task = asyncio.create_task(heartbeat(user_id=user_id, token=token))
+    except Exception as e:
+        print(e)
+        heartbeat_task.cancel()
+        await drain_after_error(user_id=user_id, token=token, mcp_server=mcp_server, scheduler=scheduler)
+    finally:
+        heartbeat_task.cancel()
+
+
+async def drain_after_error(user_id: int, token: str, mcp_server: MCPServerStdio, scheduler):
+    # Messages still queued would otherwise wait for the user's next message to start a new worker
+    try:
+        await RELEASE_LEASE(keys=[f'request_{user_id}'], args=[token])
+        token = uuid.uuid4().hex
+        if await redis.llen(f'queue_{user_id}') and \
+                await redis.set(f'request_{user_id}', token, nx=True, ex=REQUEST_LEASE_SECONDS):
+            asyncio.create_task(run_queue(user_id=user_id, token=token, mcp_server=mcp_server, scheduler=scheduler))
+    except Exception as e:
+        print(e)
+
+
+async def process_batch(user_id: int, batch: list[dict], mcp_server: MCPServerStdio, scheduler):
+    from bot.utils.send_answer import process_after_text, process_after_photo
+
+    messages = [Message.model_validate_json(item['message']).as_(bot) for item in batch]
+    wait_messages = [Message.model_validate_json(item['wait_message']).as_(bot) for item in batch]
+    for wait_message in wait_messages[:-1]:
+        try:
+            await wait_message.delete()
+        except Exception as e:
+            print(e)
+
+    async with async_session() as session:
+        user_repo = UserRepository(session)
+        utils_repo = UtilsRepository(session)
+        user = await user_repo.get_by_telegram_id(user_id)
+        i18n = translator_hub.get_translator_by_locale(user.language if user.language else 'en')
+
+        async def on_queued(position: int):
+            try:
+                await wait_messages[-1].edit_text(text=i18n.get('wait_queue_text', position=position))
+            except Exception as e:
+                print(e)
+
+        try:
+            async with run_scheduler.slot(priority=await user_priority(user_repo=user_repo, user=user),
+                                          on_queued=on_queued):
+                if batch[0]['kind'] == 'photo':
+                    await process_after_photo(message=messages[0], user=user, user_repo=user_repo,
+                                              utils_repo=utils_repo, redis=redis, i18n=i18n,
+                                              mess_to_delete=wait_messages[0],
+                                              mcp_server_1=mcp_server, scheduler=scheduler)
+                else:
+                    await process_after_text(message=messages[-1], user=user, user_repo=user_repo,
+                                             utils_repo=utils_repo, redis=redis, i18n=i18n,
+                                             mess_to_delete=wait_messages[-1],
+                                             mcp_server_1=mcp_server, scheduler=scheduler,
+                                             constant_text='\n\n'.join(item['text'] for item in batch))
+        except RunQueueFull:
+            await wait_messages[-1].edit_text(text=i18n.get('warning_text_busy'))
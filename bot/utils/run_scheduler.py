@@ -0,0 +1,108 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+
+from database.models import User
+from database.repositories.user import UserRepository
+from redis_service import metrics
+from config import AGENT_RUNS_CONCURRENCY, AGENT_RUNS_QUEUE_LIMIT, ADMIN_ID, ADMINS_LIST
+
+PRIORITY_ADMIN = 0
+PRIORITY_PAID = 1
+PRIORITY_FREE = 2
+PRIORITY_TASK = 3
+
+PRIORITY_NAMES = {PRIORITY_ADMIN: 'admin', PRIORITY_PAID: 'paid', PRIORITY_FREE: 'free', PRIORITY_TASK: 'task'}
+
+
+class RunQueueFull(Exception):
+    pass
+
+
+class RunScheduler:
+    # Limits the number of concurrent agent runs. Waiting runs start by priority, then in arrival order
+    def __init__(self, concurrency: int, queue_limit: int):
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.running = 0
+        self.waiting = []
+        self._counter = itertools.count()
+
+    def depth(self):
+        return sum(1 for _, _, future in self.waiting if not future.done())
+
+    def position(self, priority: int, order: int):
+        return sum(1 for entry in self.waiting
+                   if not entry[2].done() and (entry[0], entry[1]) <= (priority, order))
+
+    def _release(self):
+        # A finished run hands its slot straight to the next waiter
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    async def _record(self, call, *args):
+        # Metrics are best effort, a Redis error must not break the slot accounting
+        try:
+            await call(*args)
+        except Exception as e:
+            print(e)
+
+    async def _report(self):
+        await self._record(metrics.set_gauge, 'runs_active', self.running)
+        await self._record(metrics.set_gauge, 'run_queue_depth', self.depth())
+
+    @asynccontextmanager
+    async def slot(self, priority: int, on_queued=None):
+        # Scheduled tasks always wait for a slot, user requests are rejected with RunQueueFull when the queue is full
+        started = time.monotonic()
+        if self.running < self.concurrency and not self.depth():
+            self.running += 1
+        else:
+            if priority != PRIORITY_TASK and self.depth() >= self.queue_limit:
+                await self._record(metrics.incr, 'runs_rejected')
+                raise RunQueueFull()
+
+            order = next(self._counter)
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiting, (priority, order, future))
+            try:
+                await self._report()
+                if on_queued:
+                    await on_queued(self.position(priority, order))
+                await future
+            except BaseException:
+                if future.done() and not future.cancelled():
+                    self._release()
+                else:
+                    future.cancel()
+                raise
+
+        # The slot is held from here on and is released whatever happens
+        try:
+            await self._record(metrics.incr, 'runs_started')
+            await self._record(metrics.observe, f'run_wait_seconds_{PRIORITY_NAMES[priority]}',
+                               time.monotonic() - started)
+            await self._report()
+            started = time.monotonic()
+            yield
+        finally:
+            self._release()
+            await self._record(metrics.observe, 'run_seconds', time.monotonic() - started)
+            await self._report()
+
+
+async def user_priority(user_repo: UserRepository, user: User):
+    if user.telegram_id == ADMIN_ID or user.telegram_id in ADMINS_LIST:
+        return PRIORITY_ADMIN
+    if await user_repo.has_confirmed_payments(user_id=user.telegram_id):
+        return PRIORITY_PAID
+    return PRIORITY_FREE
+
+
+run_scheduler = RunScheduler(concurrency=AGENT_RUNS_CONCURRENCY, queue_limit=AGENT_RUNS_QUEUE_LIMIT)
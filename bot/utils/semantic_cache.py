@@ -0,0 +1,66 @@
+import re
+import time
+
+import numpy as np
+from openai import AsyncOpenAI
+
+from config import (SEMANTIC_CACHE_MODEL, SEMANTIC_CACHE_DIMENSIONS, SEMANTIC_CACHE_THRESHOLD,
+                    SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_MAX_AGE)
+
+
+async def embed(client: AsyncOpenAI, text: str):
+    response = await client.embeddings.create(model=SEMANTIC_CACHE_MODEL, input=text,
+                                              dimensions=SEMANTIC_CACHE_DIMENSIONS)
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def text_script(text: str):
+    # Embeddings match across languages, a cached answer is only reused for a question written in the same script
+    return 'cyrillic' if re.search(r'[а-яё]', text.lower()) else 'latin'
+
+
+class SemanticCache:
+    # Answers of previous non-personal questions in process memory. Question embeddings are the first rows of
+    # one preallocated float32 matrix, so a lookup is a single matrix-vector product
+    def __init__(self, dimensions: int, threshold: float, max_entries: int, max_age: int):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.vectors = np.zeros((max_entries, dimensions), dtype=np.float32)
+        self.entries = []
+
+    def _evict(self):
+        # Drops entries older than max_age and, when full, the oldest entry
+        oldest = time.time() - self.max_age
+        keep = [index for index, entry in enumerate(self.entries) if entry['created_at'] >= oldest]
+        keep = keep[-(self.max_entries - 1):]
+        if len(keep) != len(self.entries):
+            self.vectors[:len(keep)] = self.vectors[keep]
+            self.entries = [self.entries[index] for index in keep]
+
+    def search(self, vector: np.ndarray, script: str, knowledge_version: int):
+        if not self.entries:
+            return None
+
+        oldest = time.time() - self.max_age
+        scores = self.vectors[:len(self.entries)] @ vector
+        for index in np.argsort(-scores):
+            if scores[index] < self.threshold:
+                break
+            entry = self.entries[index]
+            # Knowledge base answers are only valid for the knowledge base version they were built from
+            if entry['created_at'] >= oldest and entry['script'] == script and \
+                    entry['knowledge_version'] in (None, knowledge_version):
+                return entry
+        return None
+
+    def add(self, vector: np.ndarray, entry: dict):
+        self._evict()
+        entry['created_at'] = time.time()
+        self.vectors[len(self.entries)] = vector
+        self.entries.append(entry)
+
+
+semantic_cache = SemanticCache(dimensions=SEMANTIC_CACHE_DIMENSIONS, threshold=SEMANTIC_CACHE_THRESHOLD,
+                               max_entries=SEMANTIC_CACHE_MAX_ENTRIES, max_age=SEMANTIC_CACHE_MAX_AGE)
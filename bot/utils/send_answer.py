@@ -1,29 +1,108 @@
+import asyncio
 import re
+import time
 
 from agents.mcp import MCPServerStdio
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.types import Message, BufferedInputFile
 from chatgpt_md_converter import telegram_format
 from redis.asyncio.client import Redis
 
-from bot.utils.calculate_tokens import calculate_tokens
-from database.models import User
+from bot.utils.calculate_tokens import calculate_tokens, estimate_tokens
+from database.models import User, ChatAttachment
 from database.repositories.user import UserRepository
 from database.repositories.utils import UtilsRepository
 from bot.utils.agent_requests import AnswerText, text_request, AnswerImage, image_request
+from bot.utils.funcs_gpt import fold_user_context
 import bot.keyboards.inline as inline_kb
-from config import TOKENS_LIMIT_FOR_WARNING_MESSAGE
-
+from config import TOKENS_LIMIT_FOR_WARNING_MESSAGE, STREAM_ANSWERS, STREAM_EDIT_INTERVAL
+
+
+class StreamWriter:
+    # Shows the answer while it is generated by editing Telegram messages at most once per STREAM_EDIT_INTERVAL.
+    # The text is re-split on every edit, so it rolls over into a new message at the length limit with valid HTML
+    def __init__(self, message: Message):
+        self.message = message
+        self.text = ''
+        self.sent = []
+        self.rendered = []
+        self.next_edit = 0
+
+    async def push(self, delta: str):
+        self.text += delta
+        if time.monotonic() >= self.next_edit:
+            await self.flush()
+
+    def reset(self):
+        # A new model response replaces the text streamed so far
+        self.text = ''
+
+    async def flush(self, reply_markup=None, final: bool = False):
+        self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        chunks = split_code_message(self.text) if self.text.strip() else []
+        for index, chunk in enumerate(chunks):
+            markup = reply_markup if index == len(chunks) - 1 else None
+            if index < len(self.rendered) and self.rendered[index] == chunk and not markup:
+                continue
+            while True:
+                try:
+                    if index < len(self.sent):
+                        await self.sent[index].edit_text(chunk, reply_markup=markup)
+                        self.rendered[index] = chunk
+                    else:
+                        self.sent.append(await self.message.answer(chunk, reply_markup=markup))
+                        self.rendered.append(chunk)
+                except TelegramRetryAfter as e:
+                    if final:
+                        await asyncio.sleep(e.retry_after)
+                        continue
+                    self.next_edit = time.monotonic() + e.retry_after
+                    return
+                except TelegramBadRequest as e:
+                    # Partial markup can be rejected mid-stream, the next edit sends the complete text
+                    if final:
+                        raise
+                    print(e)
+                break
+
+        return len(chunks)
+
+    async def finish(self, text: str, reply_markup=None):
+        self.text = text
+        count = await self.flush(reply_markup=reply_markup, final=True)
+        for sent in self.sent[count:]:
+            await sent.delete()
+        del self.sent[count:], self.rendered[count:]
+
+    async def discard(self):
+        for sent in self.sent:
+            try:
+                await sent.delete()
+            except Exception as e:
+                print(e)
+        self.sent, self.rendered = [], []
+
+
+async def send_answer_text(user_ques: str, message: Message, answer: AnswerText, user: User, user_repo: UserRepository, i18n,
+                           writer: StreamWriter = None):
+    # The turn and its credit debit are committed together before the answer is delivered
+    async with user_repo.unit_of_work():
+        _, row_id = await user_repo.add_context_pair(user_id=user.telegram_id, question=user_ques, answer=answer.answer,
+                                                     input_tokens=estimate_tokens(user_ques),
+                                                     output_tokens=answer.answer_tokens)
+        await calculate_tokens(user=user, user_repo=user_repo, input_tokens_text=answer.input_tokens,
+                               input_tokens_img=answer.input_tokens_image, output_tokens_text=answer.output_tokens,
+                               output_tokens_img=answer.output_tokens_image)
 
-async def send_answer_text(user_ques: str, message: Message, answer: AnswerText, user: User, user_repo: UserRepository, i18n):
     if answer.image_bytes:
+        if writer:
+            await writer.discard()
         await message.answer_photo(photo=BufferedInputFile(answer.image_bytes, filename=f"{user.telegram_id}.jpeg"),
                                    caption=answer.answer)
-
-        await user_repo.add_context(user_id=user.telegram_id, role='user', content=user_ques)
-        await user_repo.add_context(user_id=user.telegram_id, role='assistant', content=answer.answer)
+    elif writer:
+        await writer.finish(text=answer.answer,
+                            reply_markup=inline_kb.keyboard_md(row_id=row_id, text=i18n.get('answer_md')))
     else:
-        await user_repo.add_context(user_id=user.telegram_id, role='user', content=user_ques)
-        row_id = await user_repo.add_context(user_id=user.telegram_id, role='assistant', content=answer.answer)
         messages = split_code_message(answer.answer)
 
         for index, mess in enumerate(messages, 1):
@@ -299,6 +378,7 @@ async def process_after_text(message: Message, user: User, user_repo: UserReposi
                              utils_repo: UtilsRepository, redis: Redis, i18n,
                              mess_to_delete: Message, mcp_server_1: MCPServerStdio, scheduler, text_from_voice: str = None,
                              constant_text: str = None):
+    writer = StreamWriter(message=message) if STREAM_ANSWERS else None
     try:
         if text_from_voice:
             user_ques = text_from_voice
@@ -309,29 +389,37 @@ async def process_after_text(message: Message, user: User, user_repo: UserReposi
 
         answer = await text_request(text=user_ques, user=user,
                                     user_repo=user_repo, utils_repo=utils_repo, redis=redis, mcp_server_1=mcp_server_1,
-                                    bot=message.bot, scheduler=scheduler)
+                                    bot=message.bot, scheduler=scheduler, writer=writer)
 
         await send_answer_text(user_ques=user_ques,
-                               message=message, answer=answer, user=user, user_repo=user_repo, i18n=i18n)
+                               message=message, answer=answer, user=user, user_repo=user_repo, i18n=i18n,
+                               writer=writer)
 
         if answer.input_tokens + answer.output_tokens > TOKENS_LIMIT_FOR_WARNING_MESSAGE:
             await message.answer(i18n.get('warning_text_tokens'))
 
-        await calculate_tokens(user=user, user_repo=user_repo, input_tokens_text=answer.input_tokens,
-                               input_tokens_img=answer.input_tokens_image, output_tokens_text=answer.output_tokens,
-                               output_tokens_img=answer.output_tokens_image)
+        asyncio.create_task(fold_user_context(user_id=user.telegram_id, redis=redis))
     except Exception as e:
         print(e)
+        if writer:
+            await writer.discard()
         await message.answer(text=i18n.get('warning_text_error'))
     finally:
-        await redis.delete(f'request_{message.from_user.id}')
         await mess_to_delete.delete()
 
 
 async def send_answer_photo(message: Message, answer: AnswerImage, user: User, user_repo: UserRepository):
     caption = message.caption if message.caption else '.'
-    await user_repo.add_context(user_id=user.telegram_id, role='user', content=f'{answer.image_path}|{caption}')
-    await user_repo.add_context(user_id=user.telegram_id, role='assistant', content=answer.answer)
+    async with user_repo.unit_of_work():
+        await user_repo.add_context_pair(user_id=user.telegram_id, question=caption, answer=answer.answer,
+                                         input_tokens=estimate_tokens(caption, images=1),
+                                         output_tokens=answer.answer_tokens,
+                                         attachments=[ChatAttachment(kind='image', path=answer.image_path,
+                                                                     file_id=answer.file_id, caption=caption,
+                                                                     mime_type='image/jpeg')])
+        await calculate_tokens(user=user, user_repo=user_repo, input_tokens_text=answer.input_tokens,
+                               input_tokens_img=0, output_tokens_text=answer.output_tokens,
+                               output_tokens_img=0)
 
     messages = split_code_message(answer.answer)
 
@@ -355,11 +443,8 @@ async def process_after_photo(message: Message, user: User, user_repo: UserRepos
         if answer.input_tokens + answer.output_tokens > TOKENS_LIMIT_FOR_WARNING_MESSAGE:
             await message.answer(i18n.get('warning_text_tokens'))
 
-        await calculate_tokens(user=user, user_repo=user_repo, input_tokens_text=answer.input_tokens,
-                               input_tokens_img=0, output_tokens_text=answer.output_tokens,
-                               output_tokens_img=0)
+        asyncio.create_task(fold_user_context(user_id=user.telegram_id, redis=redis))
     except Exception as e:
         await message.answer(text=i18n.get('warning_text_error'))
     finally:
-        await redis.delete(f'request_{message.from_user.id}')
         await mess_to_delete.delete()
\ No newline at end of file
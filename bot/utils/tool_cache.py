@@ -0,0 +1,74 @@
+import asyncio
+import dataclasses
+import hashlib
+import json
+from datetime import datetime, timezone
+
+from agents import FunctionTool, RunContextWrapper
+
+from bot.utils.answer_cache import normalize_question
+from redis_service.connect import redis
+from redis_service import metrics
+
+# Calls with the same key that are in progress in this process, later callers wait for the first one
+in_flight: dict[str, asyncio.Task] = {}
+
+
+async def cached_call(key: str, ttl: int, call, name: str, cacheable=bool):
+    # call: coroutine function producing a JSON serializable result, stored for ttl seconds if cacheable(result)
+    cached = await redis.get(key)
+    if cached is not None:
+        await metrics.incr(f'tool_cache_hits_{name}')
+        return json.loads(cached)
+
+    task = in_flight.get(key)
+    if task:
+        await metrics.incr(f'tool_cache_joined_{name}')
+    else:
+        await metrics.incr(f'tool_cache_misses_{name}')
+
+        async def run():
+            try:
+                result = await call()
+                if cacheable(result):
+                    await redis.set(key, json.dumps(result), ex=ttl)
+                return result
+            finally:
+                in_flight.pop(key, None)
+
+        task = in_flight[key] = asyncio.create_task(run())
+
+    # A caller that gives up (tool timeout) does not cancel the call for the others
+    return await asyncio.shield(task)
+
+
+def normalize_input(value):
+    if isinstance(value, str):
+        return normalize_question(value)
+    if isinstance(value, dict):
+        return {name: normalize_input(item) for name, item in sorted(value.items())}
+    if isinstance(value, list):
+        return [normalize_input(item) for item in value]
+    return value
+
+
+def input_key(name: str, arguments, bucket: str = '', normalize: bool = True):
+    # normalize=False keeps the values as they are (case sensitive ids, addresses), only the key order is canonical
+    arguments = json.dumps(normalize_input(arguments) if normalize else arguments, ensure_ascii=False, sort_keys=True)
+    return f'tool_{name}_{bucket}_{hashlib.sha256(arguments.encode()).hexdigest()}'
+
+
+def is_tool_result(result):
+    # Tool errors are returned to the agent as text, they must not be cached
+    return bool(result) and not (isinstance(result, str) and result.startswith('An error occurred while running the tool'))
+
+
+def cached_tool(tool: FunctionTool, ttl: int):
+    # Results are shared between users. The key holds the UTC date, so "latest news" never crosses midnight
+    async def on_invoke_tool(ctx: RunContextWrapper, input: str):
+        bucket = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        return await cached_call(key=input_key(tool.name, json.loads(input or '{}'), bucket), ttl=ttl,
+                                 call=lambda: tool.on_invoke_tool(ctx, input), name=tool.name,
+                                 cacheable=is_tool_result)
+
+    return dataclasses.replace(tool, on_invoke_tool=on_invoke_tool)
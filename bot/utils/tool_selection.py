@@ -0,0 +1,75 @@
+import re
+
+from agents import Agent
+from openai import AsyncOpenAI
+
+from redis_service import cache
+from redis_service.connect import redis
+from config import TOOL_STICKY_SECONDS
+
+# Tools offered only when the message matches one of their patterns (or they were offered recently).
+# Tools missing here are always offered. Patterns match at the start of a word
+TOOL_KEYWORDS = {
+    'tasks_scheduler': [r'remind', r'schedul', r'task', r'daily', r'every (day|morning|evening|hour|week)',
+                        r'each (day|morning|evening|hour|week)', r'alarm', r'напомин', r'напомни', r'расписан',
+                        r'заплан', r'задач', r'ежедневн', r'кажд(ый|ое|ую) (день|утро|вечер|час|неделю)'],
+    'image_gen_tool': [r'image', r'picture', r'draw', r'paint', r'illustrat', r'logo', r'sketch', r'wallpaper',
+                       r'avatar', r'картин', r'рисун', r'нарису', r'изображ', r'логотип', r'аватар', r'обои'],
+    'deep_knowledge': [r'research', r'analy', r'in[- ]depth', r'deep', r'detail', r'report', r'compar', r'review',
+                       r'исслед', r'анализ', r'подробн', r'детальн', r'отч[её]т', r'сравн', r'обзор'],
+    'deep_analysis': [r'research', r'analy', r'in[- ]depth', r'deep', r'detail', r'report', r'compar', r'review',
+                      r'forecast', r'strateg', r'исслед', r'анализ', r'подробн', r'детальн', r'отч[её]т', r'сравн',
+                      r'обзор', r'прогноз', r'стратег'],
+    'dex_analytics': [r'token', r'dex', r'defi', r'pool', r'liquidity', r'crypto', r'coin', r'price', r'chart',
+                      r'ohlcv', r'swap', r'solana', r'sol\b', r'eth\b', r'ethereum', r'btc', r'bitcoin', r'usd[tc]',
+                      r'pump', r'memecoin', r'токен', r'пул', r'ликвидн', r'крипт', r'монет', r'курс', r'цен[аыу]',
+                      r'график', r'биткоин', r'эфир', r'солан'],
+}
+
+TOOL_PATTERNS = {name: re.compile(r'\b(' + '|'.join(patterns) + ')') for name, patterns in TOOL_KEYWORDS.items()}
+
+# Prefix of the messages sent by executed tasks, its words would select tasks_scheduler for every task run
+TASK_MESSAGE_MARKER = '<msg from Task Scheduler>'
+
+
+async def knowledge_has_files(client: AsyncOpenAI, knowledge_id: str):
+    if not knowledge_id:
+        return False
+
+    key = f'knowledge_files_{knowledge_id}'
+    files = await cache.get_value(key)
+    if files is None:
+        vector_store = await client.vector_stores.retrieve(knowledge_id)
+        files = vector_store.file_counts.completed
+        await cache.set_value(key, str(files))
+    return int(files) > 0
+
+
+async def select_tools(agent: Agent, client: AsyncOpenAI, user_id: int, text: str, knowledge_id: str):
+    # A copy of the agent with only the tools relevant to the message and the user state
+    text = (text or '').replace(TASK_MESSAGE_MARKER, '').lower()
+    matched = {name for name, pattern in TOOL_PATTERNS.items() if pattern.search(text)}
+
+    key = f'tools_{user_id}'
+    sticky = set(await redis.smembers(key))
+    if matched:
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.sadd(key, *matched)
+            pipe.expire(key, TOOL_STICKY_SECONDS)
+            await pipe.execute()
+
+    tools = []
+    for tool in agent.tools:
+        if tool.name == 'search_knowledge_base' and not await knowledge_has_files(client, knowledge_id):
+            continue
+        if tool.name in TOOL_KEYWORDS and tool.name not in matched | sticky:
+            continue
+        tools.append(tool)
+
+    return agent.clone(tools=tools)
+
+
+def used_tools(runner):
+    # Names of the tools called during the run, hosted tools are reported by their call type
+    return [getattr(item.raw_item, 'name', None) or item.raw_item.type
+            for item in runner.new_items if item.type == 'tool_call_item']
@@ -27,6 +27,143 @@ CREDITS_OUTPUT_IMAGE = 40
 # Token usage warning threshold - user gets notified when exceeded
 TOKENS_LIMIT_FOR_WARNING_MESSAGE = 15000
 
+# Conversation history budget - only the newest messages that fit into this number of tokens are sent to the agent
+HISTORY_TOKENS_LIMIT = 20000
+
+# Approximate number of tokens one image in the conversation history costs
+TOKENS_PER_IMAGE = 800
+
+# Rolling summary - once the stored conversation exceeds this number of tokens, the oldest messages
+# are folded in the background into a single summary message
+SUMMARY_TRIGGER_TOKENS = 12000
+# Number of the newest messages that are always kept verbatim next to the summary
+SUMMARY_KEEP_MESSAGES = 10
+
+# Chain turns through the OpenAI Responses API stored state (previous_response_id) instead of resending
+# the history on every request. /new and /delete restart the chain from a full history replay
+USE_PREVIOUS_RESPONSE_ID = False
+# A chain whose input grows beyond this number of tokens is restarted from the trimmed history
+CHAIN_TOKENS_LIMIT = 40000
+
+# Images from the last N user turns are sent to the agent, older ones are replaced with a short text note
+IMAGE_HISTORY_TURNS = 3
+
+# Redis cache of conversation history and vector store ids for active users.
+# Histories longer than HISTORY_CACHE_SIZE messages are always read from the database
+HISTORY_CACHE_SIZE = 200
+# Seconds an idle user's cache is kept
+CACHE_TTL = 3600
+
+# Messages a user sends while the previous answer is being generated are queued and answered in order.
+# Text messages that queued up during one run are answered together by the next agent run
+# Seconds the per-user request lease lives without a heartbeat
+REQUEST_LEASE_SECONDS = 60
+
+# Stream text answers into the chat while they are generated. Telegram limits how often a message
+# can be edited, so the streamed message is updated at most once per STREAM_EDIT_INTERVAL seconds
+STREAM_ANSWERS = True
+STREAM_EDIT_INTERVAL = 1.0
+
+# Maximum number of agent runs executed at the same time, further runs wait in a queue ordered by priority:
+# admins, paying users, free users, scheduled tasks. Users are asked to retry when the queue is full
+AGENT_RUNS_CONCURRENCY = 10
+AGENT_RUNS_QUEUE_LIMIT = 100
+
+# Chat messages older than ARCHIVE_AFTER_DAYS, or beyond the newest ARCHIVE_KEEP_MESSAGES of a user,
+# are moved to the archive table every night. Archived messages are still available for /md export
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_KEEP_MESSAGES = 500
+# The messages to archive are ranked once per run and moved in transactions of ARCHIVE_BATCH_SIZE messages
+ARCHIVE_BATCH_SIZE = 1000
+# Archived messages are deleted this number of days after they were archived
+ARCHIVE_RETENTION_DAYS = 365
+
+# The knowledge base and conversation memory tools return at most FILE_SEARCH_MAX_RESULTS passages,
+# each cut to FILE_SEARCH_PASSAGE_CHARS characters
+FILE_SEARCH_MAX_RESULTS = 5
+FILE_SEARCH_PASSAGE_CHARS = 1500
+
+# Text requests search the knowledge base and memory for the user's message while the history is loading.
+# Passages scoring at least PREFETCH_SCORE_THRESHOLD are added to the agent input, so the agent can often answer
+# without calling the search tools. The search is abandoned after PREFETCH_TIMEOUT seconds
+PREFETCH_CONTEXT = True
+PREFETCH_TIMEOUT = 1.0
+PREFETCH_SCORE_THRESHOLD = 0.5
+PREFETCH_MAX_RESULTS = 3
+
+# Seconds a main agent tool may run before the agent gets a timeout error instead of its result.
+# Independent tool calls of one turn run in parallel, so a slow tool no longer holds up the others
+TOOL_TIMEOUTS = {
+    'search_knowledge_base': 20,
+    'search_conversation_memory': 20,
+    'image_gen_tool': 120,
+    'deep_knowledge': 300,
+    'deep_analysis': 300,
+    'tasks_scheduler': 60,
+    'dex_analytics': 120,
+    'dex_info': 120,
+    'token_swap': 120,
+}
+TOOL_TIMEOUT_DEFAULT = 120
+# Tools with side effects (a signed swap, a created task) are never cancelled: after the timeout they keep running
+# in the background and the agent is told that the outcome is unknown and must not be repeated blindly
+TOOL_SIDE_EFFECTS = ['token_swap', 'tasks_scheduler']
+
+# Small talk (greetings, thanks, short acknowledgements of at most ROUTER_MAX_WORDS words) is answered by
+# a light agent without tools that only sees the last ROUTER_HISTORY_TOKENS tokens of the conversation
+ROUTE_SMALL_TALK = True
+ROUTER_MAX_WORDS = 6
+ROUTER_HISTORY_TOKENS = 2000
+
+# The main agent is only offered the tools relevant to the message: the scheduler, image generation, deep research
+# and DEX tools when the message mentions their topic, the knowledge base when it has files. A tool offered
+# to a user stays available for TOOL_STICKY_SECONDS, so follow-up messages can still use it
+TOOL_SELECTION = True
+TOOL_STICKY_SECONDS = 1800
+
+# Answers built only from the knowledge base are cached for ANSWER_CACHE_TTL seconds and reused for the same
+# question (case, punctuation and spacing ignored) until the knowledge base changes.
+# Questions that refer to the user or to the conversation are never answered from the cache
+ANSWER_CACHE = True
+ANSWER_CACHE_TTL = 7 * 24 * 3600
+
+# Paraphrases of earlier non-personal questions are answered from an in-memory semantic cache: the question
+# embedding is compared with those of cached answers and the answer is reused above SEMANTIC_CACHE_THRESHOLD
+# cosine similarity. Only answers of the routes in SEMANTIC_CACHE_ROUTES are stored:
+# 'general' - no tools used, 'knowledge' - knowledge base only, 'web' - web search only.
+# Questions about the current date, time, news or prices are never cached
+SEMANTIC_CACHE = True
+SEMANTIC_CACHE_ROUTES = ['knowledge']
+SEMANTIC_CACHE_MODEL = 'text-embedding-3-small'
+SEMANTIC_CACHE_DIMENSIONS = 512
+SEMANTIC_CACHE_THRESHOLD = 0.9
+# Questions longer than this are not looked up
+SEMANTIC_CACHE_MAX_CHARS = 300
+SEMANTIC_CACHE_MAX_ENTRIES = 5000
+# Seconds an answer is kept
+SEMANTIC_CACHE_MAX_AGE = 24 * 3600
+
+# Deep research results are shared between users: the same research request (case, punctuation and spacing
+# ignored) made on the same UTC day is answered from the cache for DEEP_KNOWLEDGE_CACHE_TTL seconds
+DEEP_KNOWLEDGE_CACHE_TTL = 3600
+
+# DexPaprika MCP tool results are cached in Redis and shared between users for the number of seconds set per tool:
+# prices and pool lists change fast, networks and DEX lists rarely. 0 disables caching of a tool
+DEXPAPRIKA_CACHE_TTLS = {
+    'getNetworks': 24 * 3600,
+    'getNetworkDexes': 3600,
+    'getStats': 600,
+    'search': 600,
+    'getPoolOHLCV': 300,
+    'getNetworkPools': 60,
+    'getDexPools': 60,
+    'getTokenPools': 60,
+    'getPoolDetails': 30,
+    'getTokenDetails': 30,
+    'getPoolTransactions': 15,
+}
+DEXPAPRIKA_CACHE_TTL_DEFAULT = 60
+
 # Supported languages configuration
 AVAILABLE_LANGUAGES = ['en', 'ru']
 AVAILABLE_LANGUAGES_WORDS = ['English', 'Русский']
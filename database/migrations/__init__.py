@@ -0,0 +1,12 @@
+import os
+
+from alembic import command
+from alembic.config import Config
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'alembic.ini')
+
+
+def run_migrations(connection, revision: str = 'head'):
+    config = Config(ALEMBIC_INI)
+    config.attributes['connection'] = connection
+    command.upgrade(config, revision)
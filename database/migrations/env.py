@@ -0,0 +1,68 @@
+import asyncio
+import os
+from logging.config import fileConfig
+
+from alembic import context
+from dotenv import load_dotenv
+from sqlalchemy.pool import NullPool
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from database.models import Base
+
+load_dotenv()
+
+config = context.config
+
+# Startup passes its own connection, logging is already configured by the bot
+if config.config_file_name is not None and 'connection' not in config.attributes:
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
+
+target_metadata = Base.metadata
+
+# Tables managed outside of the models
+EXCLUDE_TABLES = {'apscheduler_jobs'}
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    if type_ == 'table' and name in EXCLUDE_TABLES:
+        return False
+    return True
+
+
+def do_run_migrations(connection):
+    context.configure(connection=connection, target_metadata=target_metadata, include_object=include_object)
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_offline():
+    context.configure(url=os.getenv('DATABASE_URL'), target_metadata=target_metadata,
+                      include_object=include_object, literal_binds=True,
+                      dialect_opts={'paramstyle': 'named'})
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+async def run_async_migrations():
+    connectable = create_async_engine(os.getenv('DATABASE_URL'), poolclass=NullPool)
+
+    async with connectable.connect() as connection:
+        await connection.run_sync(do_run_migrations)
+
+    await connectable.dispose()
+
+
+def run_migrations_online():
+    connection = config.attributes.get('connection')
+    if connection is not None:
+        do_run_migrations(connection)
+    else:
+        asyncio.run(run_async_migrations())
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
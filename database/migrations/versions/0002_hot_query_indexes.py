@@ -0,0 +1,38 @@
+"""hot query indexes
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 12:10:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# The same indexes are declared on the models, so create_all may have created them already
+INDEXES = [
+    ('ix_chat_messages_user_id_id', 'chat_messages', ['user_id', 'id']),
+    ('ix_payments_random_suffix_created_at', 'payments', ['random_suffix', 'created_at']),
+    ('ix_user_tasks_user_id_is_active', 'user_tasks', ['user_id', 'is_active']),
+    ('ix_memory_vectors_user_id', 'memory_vectors', ['user_id']),
+    ('ix_wallets_user_id', 'wallets', ['user_id']),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
@@ -4,12 +4,13 @@ from dotenv import load_dotenv
 
 from sqlalchemy import (
     Column, Integer, String, Boolean, DateTime, ForeignKey, Float, Text, Table, BigInteger,
-    TIMESTAMP, func
+    TIMESTAMP, Index, func
 )
 from sqlalchemy.orm import relationship, declarative_base
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 
 from config import START_BALANCE
+from database.migrations import run_migrations
 
 load_dotenv()
 
@@ -32,6 +33,7 @@ class User(Base):
     telegram_id = Column(BigInteger, primary_key=True)
     language = Column(String(10), nullable=True)
     balance_credits = Column(Float, default=START_BALANCE)
+    last_refill_at = Column(TIMESTAMP(timezone=True), nullable=True)  # last daily credit refill
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
 
     wallets = relationship('Wallet', back_populates='user')
@@ -43,6 +45,7 @@ class User(Base):
 
 class ChatMessage(Base):
     __tablename__ = 'chat_messages'
+    __table_args__ = (Index('ix_chat_messages_user_id_id', 'user_id', 'id'),)
 
     id = Column(Integer, primary_key=True)
     user_id = Column(BigInteger, ForeignKey('users.telegram_id'))
@@ -53,10 +56,49 @@ class ChatMessage(Base):
     timestamp = Column(TIMESTAMP(timezone=True), server_default=func.now())
 
     user = relationship('User', back_populates='messages')
+    attachments = relationship('ChatAttachment', back_populates='message', lazy='selectin', passive_deletes=True)
+
+
+class ChatMessageArchive(Base):
+    __tablename__ = 'chat_messages_archive'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)  # id of the archived chat_messages row
+    user_id = Column(BigInteger, ForeignKey('users.telegram_id'), index=True)
+    role = Column(String(20))
+    content = Column(Text)
+    input_tokens = Column(Integer, nullable=True)
+    output_tokens = Column(Integer, nullable=True)
+    timestamp = Column(TIMESTAMP(timezone=True))
+    archived_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), index=True)
+
+
+class ChatAttachment(Base):
+    __tablename__ = 'chat_attachments'
+
+    id = Column(Integer, primary_key=True)
+    message_id = Column(Integer, ForeignKey('chat_messages.id', ondelete='CASCADE'), index=True)
+    user_id = Column(BigInteger, ForeignKey('users.telegram_id'), index=True)
+    kind = Column(String(20), nullable=False)  # 'image'
+    path = Column(Text, nullable=True)
+    file_id = Column(Text, nullable=True)  # OpenAI file id, set once the attachment is uploaded
+    caption = Column(Text, nullable=True)
+    mime_type = Column(String(100), nullable=True)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+
+    message = relationship('ChatMessage', back_populates='attachments')
+
+
+class ConversationState(Base):
+    __tablename__ = 'conversation_states'
+
+    user_id = Column(BigInteger, ForeignKey('users.telegram_id'), primary_key=True)
+    last_response_id = Column(Text, nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now())
 
 
 class Payment(Base):
     __tablename__ = 'payments'
+    __table_args__ = (Index('ix_payments_random_suffix_created_at', 'random_suffix', 'created_at'),)
 
     id = Column(Integer, primary_key=True)
 
@@ -72,6 +114,20 @@ class Payment(Base):
     user = relationship('User', back_populates='payments')
 
 
+class CreditLedger(Base):
+    __tablename__ = 'credit_ledger'
+    __table_args__ = (Index('ix_credit_ledger_user_id_id', 'user_id', 'id'),)
+
+    id = Column(BigInteger, primary_key=True)
+    user_id = Column(BigInteger, ForeignKey('users.telegram_id'))
+    amount = Column(Float, nullable=False)  # negative for debits
+    balance_after = Column(Float, nullable=False)
+    reason = Column(String(20), nullable=False)  # start, usage, payment, refill
+    input_tokens = Column(Integer, nullable=True)
+    output_tokens = Column(Integer, nullable=True)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+
+
 class TokenPrice(Base):
     __tablename__ = 'token_prices'
 
@@ -83,6 +139,7 @@ class TokenPrice(Base):
 
 class Wallet(Base):
     __tablename__ = 'wallets'
+    __table_args__ = (Index('ix_wallets_user_id', 'user_id'),)
 
     id = Column(Integer, primary_key=True)
     user_id = Column(BigInteger, ForeignKey('users.telegram_id'))
@@ -102,6 +159,7 @@ class KnowledgeVector(Base):
 
 class MemoryVector(Base):
     __tablename__ = 'memory_vectors'
+    __table_args__ = (Index('ix_memory_vectors_user_id', 'user_id'),)
 
     id = Column(Integer, primary_key=True)
     user_id = Column(BigInteger, ForeignKey('users.telegram_id'))
@@ -124,6 +182,7 @@ class Logs(Base):
 
 class UserTasks(Base):
     __tablename__ = 'user_tasks'
+    __table_args__ = (Index('ix_user_tasks_user_id_is_active', 'user_id', 'is_active'),)
 
     id = Column(Integer, primary_key=True)
     user_id = Column(BigInteger, ForeignKey('users.telegram_id'))
@@ -146,3 +205,5 @@ async def create_tables():
     async with engine.begin() as conn:
         # await conn.run_sync(Base.metadata.drop_all)
         await conn.run_sync(Base.metadata.create_all)
+        # Brings databases created by earlier versions up to date, new tables already match the models
+        await conn.run_sync(run_migrations)
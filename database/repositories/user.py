@@ -1,14 +1,93 @@
 import base64
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
 
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import and_, select, delete, update, asc
+from sqlalchemy import and_, or_, select, delete, update, asc, desc, func
+from sqlalchemy.dialects.postgresql import insert
 
-from database.models import User, ChatMessage, Wallet, MemoryVector, Payment, UserTasks
+from database.models import (User, ChatMessage, ChatMessageArchive, ChatAttachment, Wallet, MemoryVector, Payment,
+                             UserTasks, ConversationState, CreditLedger)
+from redis_service import cache
+from config import HISTORY_CACHE_SIZE
+
+
+def message_tokens():
+    # Tokens a history row costs; rows stored before token counts existed fall back to a length based estimate
+    return func.coalesce(ChatMessage.input_tokens, ChatMessage.output_tokens,
+                         func.char_length(ChatMessage.content) / 4)
+
+
+def attachment_to_dict(attachment: ChatAttachment):
+    return {'id': attachment.id, 'kind': attachment.kind, 'path': attachment.path,
+            'file_id': attachment.file_id, 'caption': attachment.caption, 'mime_type': attachment.mime_type}
+
+
+def message_to_dict(message: ChatMessage):
+    return {'id': message.id, 'role': message.role, 'content': message.content,
+            'input_tokens': message.input_tokens, 'output_tokens': message.output_tokens,
+            'attachments': [attachment_to_dict(attachment) for attachment in message.attachments]}
+
+
+def message_from_dict(data: dict):
+    # Detached ChatMessage built from the Redis cache, never added to a session
+    return ChatMessage(id=data['id'], role=data['role'], content=data['content'],
+                       input_tokens=data['input_tokens'], output_tokens=data['output_tokens'],
+                       attachments=[ChatAttachment(**attachment) for attachment in data['attachments']])
+
+
+def history_window(messages: list, max_tokens: int):
+    # Same selection as the SQL window in get_messages_window, applied to cached messages
+    window = []
+    running_tokens = 0
+    for message in reversed(messages):
+        if message.input_tokens is not None:
+            running_tokens += message.input_tokens
+        elif message.output_tokens is not None:
+            running_tokens += message.output_tokens
+        else:
+            running_tokens += len(message.content) / 4
+        if running_tokens <= max_tokens or message.role == 'system':
+            window.append(message)
+    return window[::-1]
 
 
 class UserRepository:
     def __init__(self, session: AsyncSession):
         self.session = session
+        self._in_unit_of_work = False
+        self._commit_callbacks = []
+
+    @asynccontextmanager
+    async def unit_of_work(self):
+        # Writes made inside the block are flushed and committed once at the end, as one transaction
+        self._in_unit_of_work = True
+        try:
+            yield
+            await self.session.commit()
+        except BaseException:
+            await self.session.rollback()
+            self._commit_callbacks.clear()
+            raise
+        finally:
+            self._in_unit_of_work = False
+
+        callbacks, self._commit_callbacks = self._commit_callbacks, []
+        for callback in callbacks:
+            await callback()
+
+    async def _commit(self):
+        if self._in_unit_of_work:
+            await self.session.flush()
+        else:
+            await self.session.commit()
+
+    async def _on_commit(self, callback):
+        # Cache updates must not run before the transaction they describe is committed
+        if self._in_unit_of_work:
+            self._commit_callbacks.append(callback)
+        else:
+            await callback()
 
     async def get_by_telegram_id(self, telegram_id: int):
         return await self.session.get(User, telegram_id)
@@ -19,24 +98,44 @@ class UserRepository:
         if not user:
             user = User(telegram_id=telegram_id, **kwargs)
             self.session.add(user)
-            await self.session.commit()
+            if 'balance_credits' in kwargs:
+                await self.session.flush()
+                self.session.add(CreditLedger(user_id=telegram_id, amount=kwargs['balance_credits'],
+                                              balance_after=kwargs['balance_credits'], reason='start'))
+            await self._commit()
 
         return user
 
     async def update(self, user: User, **kwargs):
-        if 'balance_credits' in kwargs:
-            kwargs['balance_credits'] = user.balance_credits - kwargs['balance_credits']
-
         await self.session.execute(
             update(User).where(User.telegram_id == user.telegram_id).values(**kwargs)
         )
 
-        await self.session.commit()
+        await self._commit()
 
     async def delete_chat_messages(self, user: User):
         await self.session.execute(delete(ChatMessage).where(ChatMessage.user_id == user.telegram_id))
+        await self.session.execute(delete(ChatMessageArchive).where(ChatMessageArchive.user_id == user.telegram_id))
+        await self.session.execute(delete(ConversationState).where(ConversationState.user_id == user.telegram_id))
+
+        await self._commit()
+        await self._on_commit(lambda: cache.invalidate_history(user.telegram_id))
+
+    async def get_last_response_id(self, user_id: int):
+        return await self.session.scalar(select(ConversationState.last_response_id).
+                                         where(ConversationState.user_id == user_id))
+
+    async def set_last_response_id(self, user_id: int, response_id: str):
+        await self.session.execute(insert(ConversationState).
+                                   values(user_id=user_id, last_response_id=response_id).
+                                   on_conflict_do_update(index_elements=[ConversationState.user_id],
+                                                         set_={'last_response_id': response_id,
+                                                               'updated_at': func.now()}))
+        await self._commit()
 
-        await self.session.commit()
+    async def delete_last_response_id(self, user_id: int):
+        await self.session.execute(delete(ConversationState).where(ConversationState.user_id == user_id))
+        await self._commit()
 
     async def get_wallet(self, user_id: int):
         wallet = await self.session.scalar(select(Wallet.encrypted_private_key).where(Wallet.user_id == user_id))
@@ -55,27 +154,133 @@ class UserRepository:
                                            )
                 ).fetchall()
 
+    async def get_messages_window(self, user_id: int, max_tokens: int):
+        # Newest messages whose running token total fits into max_tokens, returned in chronological order.
+        # The rolling summary row is always included. Served from the Redis cache when the history is cached.
+        cached = await cache.get_history(user_id)
+        if cached is not None:
+            return history_window([message_from_dict(message) for message in cached], max_tokens)
+
+        generation = await cache.history_generation(user_id)
+        messages = (await self.session.scalars(select(ChatMessage).
+                                               where(ChatMessage.user_id == user_id).
+                                               order_by(desc(ChatMessage.id)).
+                                               limit(HISTORY_CACHE_SIZE + 1)
+                                               )
+                    ).fetchall()[::-1]
+        if len(messages) <= HISTORY_CACHE_SIZE:
+            await cache.set_history(user_id, [message_to_dict(message) for message in messages], generation)
+            return history_window(messages, max_tokens)
+
+        window = (select(ChatMessage.id,
+                         func.sum(message_tokens()).over(order_by=desc(ChatMessage.id)).label('running_tokens')).
+                  where(ChatMessage.user_id == user_id).
+                  subquery())
+
+        return (await self.session.scalars(select(ChatMessage).
+                                           join(window, window.c.id == ChatMessage.id).
+                                           where(or_(window.c.running_tokens <= max_tokens,
+                                                     ChatMessage.role == 'system')).
+                                           order_by(asc(ChatMessage.id))
+                                           )
+                ).fetchall()
+
+    async def get_context_tokens(self, user_id: int):
+        return await self.session.scalar(select(func.coalesce(func.sum(message_tokens()), 0)).
+                                         where(ChatMessage.user_id == user_id))
+
+    async def fold_messages(self, user_id: int, last_id: int, summary: str, tokens: int):
+        # Folded messages move to the archive, so /md keeps working for them, the previous summary is dropped.
+        # The new summary takes the id of the last folded message to keep its place before the remaining messages;
+        # get_row_for_md skips summary rows, so that id still resolves to the archived answer
+        folded = and_(ChatMessage.user_id == user_id, ChatMessage.id <= last_id)
+        columns = ['id', 'user_id', 'role', 'content', 'input_tokens', 'output_tokens', 'timestamp']
+        moved = (delete(ChatMessage).where(and_(folded, ChatMessage.role != 'system')).
+                 returning(*[getattr(ChatMessage, column) for column in columns]).
+                 cte('moved'))
+        await self.session.execute(insert(ChatMessageArchive).
+                                   from_select(columns, select(*[moved.c[column] for column in columns])))
+        await self.session.execute(delete(ChatMessage).where(folded))
+        await self.session.execute(insert(ChatMessage).values(id=last_id, user_id=user_id, role='system',
+                                                              content=summary, input_tokens=tokens))
+        await self._commit()
+        await self._on_commit(lambda: cache.invalidate_history(user_id))
+
     async def get_memory_vector(self, user_id: int):
-        return await self.session.scalar(select(MemoryVector).where(MemoryVector.user_id == user_id))
+        id_vector = await cache.get_value(f'memory_vector_{user_id}')
+        if id_vector:
+            return MemoryVector(user_id=user_id, id_vector=id_vector)
+
+        memory_vector = await self.session.scalar(select(MemoryVector).where(MemoryVector.user_id == user_id))
+        if memory_vector:
+            await cache.set_value(f'memory_vector_{user_id}', memory_vector.id_vector)
+        return memory_vector
 
     async def add_memory_vector(self, user_id: int, vector_store_id: int):
         memory_vector = MemoryVector(user_id=user_id, id_vector=vector_store_id)
         self.session.add(memory_vector)
-        await self.session.commit()
+        await self._commit()
+        await self._on_commit(lambda: cache.invalidate(f'memory_vector_{user_id}'))
 
     async def delete_memory_vector(self, user_id: int):
         await self.session.execute(delete(MemoryVector).where(MemoryVector.user_id == user_id))
-        await self.session.commit()
+        await self._commit()
+        await self._on_commit(lambda: cache.invalidate(f'memory_vector_{user_id}'))
 
-    async def add_context(self, user_id: int, role: str, content: str):
-        chat_message = ChatMessage(user_id=user_id, role=role, content=content)
+    async def add_context(self, user_id: int, role: str, content: str,
+                          input_tokens: int = None, output_tokens: int = None,
+                          attachments: list[ChatAttachment] = None):
+        chat_message = ChatMessage(user_id=user_id, role=role, content=content,
+                                   input_tokens=input_tokens, output_tokens=output_tokens)
+        for attachment in attachments or []:
+            attachment.user_id = user_id
+            chat_message.attachments.append(attachment)
         self.session.add(chat_message)
-        await self.session.commit()
+        await self._commit()
+        await self._on_commit(lambda: cache.append_history(user_id, message_to_dict(chat_message)))
         return chat_message.id
 
+    async def add_context_pair(self, user_id: int, question: str, answer: str,
+                               input_tokens: int = None, output_tokens: int = None,
+                               attachments: list[ChatAttachment] = None):
+        # The user message and the assistant answer of one turn are written with a single multi-row insert
+        rows = [{'user_id': user_id, 'role': 'user', 'content': question,
+                 'input_tokens': input_tokens, 'output_tokens': None},
+                {'user_id': user_id, 'role': 'assistant', 'content': answer,
+                 'input_tokens': None, 'output_tokens': output_tokens}]
+        question_id, answer_id = (await self.session.scalars(
+            insert(ChatMessage).returning(ChatMessage.id, sort_by_parameter_order=True), rows
+        )).all()
+
+        for attachment in attachments or []:
+            attachment.user_id = user_id
+            attachment.message_id = question_id
+            self.session.add(attachment)
+        await self._commit()
+
+        cached = [{'id': question_id, 'role': 'user', 'content': question,
+                   'input_tokens': input_tokens, 'output_tokens': None,
+                   'attachments': [attachment_to_dict(attachment) for attachment in attachments or []]},
+                  {'id': answer_id, 'role': 'assistant', 'content': answer,
+                   'input_tokens': None, 'output_tokens': output_tokens, 'attachments': []}]
+        await self._on_commit(lambda: cache.append_history(user_id, *cached))
+        return question_id, answer_id
+
+    async def get_attachments(self, user_id: int, last_message_id: int = None):
+        query = select(ChatAttachment).where(ChatAttachment.user_id == user_id)
+        if last_message_id:
+            query = query.where(ChatAttachment.message_id <= last_message_id)
+        return (await self.session.scalars(query)).fetchall()
+
+    async def set_attachment_file_id(self, user_id: int, attachment_id: int, file_id: str):
+        await self.session.execute(update(ChatAttachment).where(ChatAttachment.id == attachment_id).
+                                   values(file_id=file_id))
+        await self._commit()
+        await self._on_commit(lambda: cache.invalidate_history(user_id))
+
     async def delete_wallet_key(self, user_id: int):
         await self.session.execute(delete(Wallet).where(Wallet.user_id == user_id))
-        await self.session.commit()
+        await self._commit()
 
     async def add_wallet_key(self, user_id: int, key: str):
         await self.delete_wallet_key(user_id=user_id)
@@ -84,28 +289,77 @@ class UserRepository:
         base64_string = base64_bytes.decode('utf-8')
         wallet = Wallet(user_id=user_id, encrypted_private_key=base64_string)
         self.session.add(wallet)
-        await self.session.commit()
+        await self._commit()
 
     async def add_payment(self, user_id: int, amount: int, crypto_amount: str,
                           crypto_currency: str, random_suffix: str):
         payment = Payment(user_id=user_id, amount_usd=amount, crypto_amount=crypto_amount,
                           crypto_currency=crypto_currency, random_suffix=random_suffix)
         self.session.add(payment)
-        await self.session.commit()
+        await self._commit()
         return payment.id
 
+    async def change_credits(self, user_id: int, amount: float, reason: str,
+                             input_tokens: int = None, output_tokens: int = None):
+        # Balances only change through a single atomic UPDATE, every change is recorded in the ledger
+        balance = await self.session.scalar(update(User).where(User.telegram_id == user_id).
+                                            values(balance_credits=User.balance_credits + amount).
+                                            returning(User.balance_credits))
+        self.session.add(CreditLedger(user_id=user_id, amount=amount, balance_after=balance, reason=reason,
+                                      input_tokens=input_tokens, output_tokens=output_tokens))
+        await self._commit()
+        return balance
+
+    async def refill_credits(self, user: User, daily_credits: float):
+        # Tops the balance up to daily_credits on the first request of a new UTC day
+        today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        if user.last_refill_at and user.last_refill_at >= today:
+            return
+
+        # The row is locked before it is read, so concurrent requests refill it only once
+        previous = (select(User.telegram_id, User.balance_credits).
+                    where(and_(User.telegram_id == user.telegram_id,
+                               or_(User.last_refill_at.is_(None), User.last_refill_at < today))).
+                    with_for_update().
+                    cte('previous'))
+        row = (await self.session.execute(update(User).
+                                          where(User.telegram_id == previous.c.telegram_id).
+                                          values(balance_credits=func.greatest(User.balance_credits, daily_credits),
+                                                 last_refill_at=func.now()).
+                                          returning(User.balance_credits, previous.c.balance_credits).
+                                          execution_options(synchronize_session=False)
+                                          )).first()
+        if row:
+            balance, previous_balance = row
+            if balance > previous_balance:
+                self.session.add(CreditLedger(user_id=user.telegram_id, amount=balance - previous_balance,
+                                              balance_after=balance, reason='refill'))
+        await self._commit()
+        await self.session.refresh(user)
+
+    async def debit_credits(self, user_id: int, credits: float, input_tokens: int = None, output_tokens: int = None):
+        return await self.change_credits(user_id=user_id, amount=-credits, reason='usage',
+                                         input_tokens=input_tokens, output_tokens=output_tokens)
+
     async def add_user_credits(self, user_id: int, balance_credits: int):
-        await self.session.execute(update(User).where(User.telegram_id == user_id).
-                                   values(balance_credits=User.balance_credits + balance_credits))
-        await self.session.commit()
+        return await self.change_credits(user_id=user_id, amount=balance_credits, reason='payment')
+
+    async def has_confirmed_payments(self, user_id: int):
+        return await self.session.scalar(select(Payment.id).
+                                         where(and_(Payment.user_id == user_id, Payment.status == 'confirmed')).
+                                         limit(1)) is not None
 
     async def get_row_for_md(self, row_id: int):
-        return await self.session.scalar(select(ChatMessage).where(ChatMessage.id == row_id))
+        row = await self.session.scalar(select(ChatMessage).where(and_(ChatMessage.id == row_id,
+                                                                       ChatMessage.role != 'system')))
+        if not row:
+            row = await self.session.scalar(select(ChatMessageArchive).where(ChatMessageArchive.id == row_id))
+        return row
 
     async def add_task(self, user_id: int, **kwargs):
         task = UserTasks(user_id=user_id, **kwargs)
         self.session.add(task)
-        await self.session.commit()
+        await self._commit()
         return task.id
 
     async def get_task(self, user_id: int, task_id: int):
@@ -116,8 +370,8 @@ class UserRepository:
 
     async def delete_task(self, user_id: int, task_id: int):
         await self.session.execute(delete(UserTasks).where(and_(UserTasks.user_id == user_id, UserTasks.id == task_id)))
-        await self.session.commit()
+        await self._commit()
 
     async def update_task(self, user_id: int, task_id: int, **kwargs):
         await self.session.execute(update(UserTasks).where(and_(UserTasks.user_id == user_id, UserTasks.id == task_id)).values(**kwargs))
-        await self.session.commit()
+        await self._commit()
@@ -1,10 +1,11 @@
 from datetime import datetime, timezone, timedelta
 
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import and_, select, delete, desc, update, or_
+from sqlalchemy import and_, select, delete, insert, desc, update, or_, func
 
-from database.models import User, ChatMessage, TokenPrice, KnowledgeVector, Payment
-from config import ADMIN_ID, CREDITS_ADMIN_DAILY, CREDITS_USER_DAILY, ADMINS_LIST
+from database.models import (ChatMessage, ChatMessageArchive, ChatAttachment, TokenPrice, KnowledgeVector,
+                             Payment)
+from redis_service import cache
 
 
 class UtilsRepository:
@@ -27,16 +28,25 @@ class UtilsRepository:
         return token
 
     async def get_knowledge_vectore_store_id(self):
-        return await self.session.scalar(select(KnowledgeVector))
+        id_vector = await cache.get_value('knowledge_vector')
+        if id_vector:
+            return KnowledgeVector(id_vector=id_vector)
+
+        knowledge_vector = await self.session.scalar(select(KnowledgeVector))
+        if knowledge_vector:
+            await cache.set_value('knowledge_vector', knowledge_vector.id_vector)
+        return knowledge_vector
 
     async def add_knowledge_vectore_store_id(self, vectore_store_id):
         vectore_store = KnowledgeVector(id_vector=vectore_store_id)
         self.session.add(vectore_store)
         await self.session.commit()
+        await cache.invalidate('knowledge_vector')
 
     async def delete_knowledge_vectore_store_id(self):
         await self.session.execute(delete(KnowledgeVector))
         await self.session.commit()
+        await cache.invalidate('knowledge_vector')
 
     async def check_payment_suffix(self, suffix: str):
         payment = await self.session.scalar(select(Payment).
@@ -59,15 +69,62 @@ class UtilsRepository:
         await self.session.execute(update(Payment).where(Payment.id == payment_id).values(status=status))
         await self.session.commit()
 
-    async def update_tokens_daily(self):
-        await self.session.execute(update(User).where(and_(User.telegram_id != ADMIN_ID,
-                                                           User.telegram_id.notin_(ADMINS_LIST),
-                                                           User.balance_credits < CREDITS_USER_DAILY)
-                                                      ).values(balance_credits=CREDITS_USER_DAILY))
-
-        await self.session.execute(update(User).where(and_(or_(User.telegram_id == ADMIN_ID,
-                                                               User.telegram_id.in_(ADMINS_LIST)
-                                                               ),
-                                                           User.balance_credits < CREDITS_ADMIN_DAILY)
-                                                      ).values(balance_credits=CREDITS_ADMIN_DAILY))
-        await self.session.commit()
\ No newline at end of file
+    async def convert_legacy_image_messages(self):
+        # Photos used to be stored as 'path|caption' in ChatMessage.content
+        messages = (await self.session.scalars(select(ChatMessage).
+                                               where(and_(ChatMessage.role == 'user',
+                                                          ChatMessage.content.like('images/image_%|%'),
+                                                          ~ChatMessage.attachments.any()))
+                                               )).fetchall()
+        for message in messages:
+            path, caption = message.content.split('|', 1)
+            message.attachments.append(ChatAttachment(user_id=message.user_id, kind='image', path=path,
+                                                      caption=caption, mime_type='image/jpeg'))
+            message.content = caption
+
+        await self.session.commit()
+        for user_id in {message.user_id for message in messages}:
+            await cache.invalidate_history(user_id)
+
+    async def get_archivable_message_ids(self, older_than: datetime, keep_messages: int):
+        # Ids of the messages older than older_than, or beyond the newest keep_messages of their user, in one
+        # ranking pass over the table. Summary rows stay
+        ranked = (select(ChatMessage.id, ChatMessage.role, ChatMessage.timestamp,
+                         func.row_number().over(partition_by=ChatMessage.user_id,
+                                                order_by=desc(ChatMessage.id)).label('position')).
+                  subquery())
+        return (await self.session.scalars(select(ranked.c.id).
+                                           where(and_(ranked.c.role != 'system',
+                                                      or_(ranked.c.timestamp < older_than,
+                                                          ranked.c.position > keep_messages))).
+                                           order_by(ranked.c.id)
+                                           )).fetchall()
+
+    async def archive_chat_messages(self, ids: list[int]):
+        # Moves the messages to the archive table. Returns the number of moved messages and their attachments
+        if not ids:
+            return 0, []
+
+        columns = ['id', 'user_id', 'role', 'content', 'input_tokens', 'output_tokens', 'timestamp']
+        # A listed message may have been folded since the ids were ranked, its id then holds the live summary
+        moved = (delete(ChatMessage).where(and_(ChatMessage.id.in_(ids), ChatMessage.role != 'system')).
+                 returning(*[getattr(ChatMessage, column) for column in columns]).
+                 cte('moved'))
+        rows = (await self.session.execute(insert(ChatMessageArchive).
+                                           from_select(columns, select(*[moved.c[column] for column in columns])).
+                                           returning(ChatMessageArchive.id, ChatMessageArchive.user_id)
+                                           )).fetchall()
+        attachments = []
+        if rows:
+            attachments = (await self.session.scalars(select(ChatAttachment).
+                                                      where(ChatAttachment.message_id.in_([row.id for row in rows]))
+                                                      )).fetchall()
+        await self.session.commit()
+
+        for user_id in {row.user_id for row in rows}:
+            await cache.invalidate_history(user_id)
+        return len(rows), attachments
+
+    async def purge_archived_messages(self, older_than: datetime):
+        await self.session.execute(delete(ChatMessageArchive).where(ChatMessageArchive.archived_at < older_than))
+        await self.session.commit()
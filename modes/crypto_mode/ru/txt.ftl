@@ -81,6 +81,10 @@ warning_text_no_credits = Недостаточно кредитов!
 
 wait_answer_text = Минуточку ✨
 
+wait_queue_text = Все агенты заняты, ваш запрос { $position } в очереди ⏳
+
+warning_text_busy = Сейчас слишком много запросов, попробуйте через минуту.
+
 answer_md = Скачать ответ
 
 warning_text_tokens = Размер диалога превышает 25 000 токенов! Для экономии вы можете сохранить диалог в память системы или удалить его через меню после решения текущей задачи.
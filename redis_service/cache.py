@@ -0,0 +1,104 @@
+import json
+
+from redis_service.connect import redis
+from config import HISTORY_CACHE_SIZE, CACHE_TTL, ANSWER_CACHE_TTL
+
+# The first element of a cached history list; a cached list always holds the complete history after it
+HISTORY_HEAD = '{}'
+
+
+async def get_history(user_id: int):
+    key = f'history_{user_id}'
+    items = await redis.lrange(key, 0, -1)
+    if not items or items[0] != HISTORY_HEAD:
+        return None
+
+    await redis.expire(key, CACHE_TTL)
+    return [json.loads(item) for item in items[1:]]
+
+
+# Writes a history read from the database only if no invalidation happened since the read started.
+# KEYS: history, generation. ARGV: generation seen before the read, ttl, items
+SET_HISTORY = redis.register_script("""
+if (redis.call('get', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('del', KEYS[1])
+redis.call('rpush', KEYS[1], unpack(ARGV, 3))
+redis.call('expire', KEYS[1], ARGV[2])
+return 1
+""")
+
+
+async def history_generation(user_id: int):
+    # Must be read before the database read whose result is passed to set_history
+    return await redis.get(f'history_gen_{user_id}') or '0'
+
+
+async def set_history(user_id: int, messages: list[dict], generation: str):
+    key = f'history_{user_id}'
+    if len(messages) > HISTORY_CACHE_SIZE:
+        return await redis.delete(key)
+
+    await SET_HISTORY(keys=[key, f'history_gen_{user_id}'],
+                      args=[generation, CACHE_TTL, HISTORY_HEAD, *[json.dumps(message) for message in messages]])
+
+
+# Extends an already cached history and bumps the generation, a read that started before the appended
+# messages were committed must not store its list. KEYS: history, generation. ARGV: max length, ttl, items
+APPEND_HISTORY = redis.register_script("""
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], ARGV[2])
+local length = redis.call('rpushx', KEYS[1], unpack(ARGV, 3))
+if length > tonumber(ARGV[1]) then
+    redis.call('del', KEYS[1])
+elseif length > 0 then
+    redis.call('expire', KEYS[1], ARGV[2])
+end
+return length
+""")
+
+
+async def append_history(user_id: int, *messages: dict):
+    # Only extends an already cached history, a missing key is filled from the database on the next read
+    await APPEND_HISTORY(keys=[f'history_{user_id}', f'history_gen_{user_id}'],
+                         args=[HISTORY_CACHE_SIZE + 1, CACHE_TTL, *[json.dumps(message) for message in messages]])
+
+
+async def invalidate_history(user_id: int):
+    # The generation outlives the cached history, so a read that started before this call cannot store it again
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.incr(f'history_gen_{user_id}')
+        pipe.expire(f'history_gen_{user_id}', CACHE_TTL)
+        pipe.delete(f'history_{user_id}')
+        await pipe.execute()
+
+
+async def get_value(key: str):
+    return await redis.get(key)
+
+
+async def set_value(key: str, value: str):
+    await redis.set(key, value, ex=CACHE_TTL)
+
+
+async def invalidate(key: str):
+    await redis.delete(key)
+
+
+async def knowledge_version():
+    # Incremented on every knowledge base change, cached answers of older versions are no longer read
+    return int(await redis.get('knowledge_version') or 0)
+
+
+async def invalidate_answers():
+    await redis.incr('knowledge_version')
+
+
+async def get_answer(key: str):
+    answer = await redis.get(key)
+    return json.loads(answer) if answer else None
+
+
+async def set_answer(key: str, answer: dict):
+    await redis.set(key, json.dumps(answer), ex=ANSWER_CACHE_TTL)
@@ -0,0 +1,36 @@
+from datetime import datetime, timezone
+
+from redis_service.connect import redis
+
+# Counters and sums are kept per UTC day in metrics_{YYYY-MM-DD}, gauges hold the current value only
+METRICS_TTL = 30 * 24 * 3600
+
+
+def metrics_key(day: str = None):
+    return f'metrics_{day if day else datetime.now(timezone.utc).strftime("%Y-%m-%d")}'
+
+
+async def incr(name: str, amount: int = 1):
+    key = metrics_key()
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hincrby(key, name, amount)
+        pipe.expire(key, METRICS_TTL)
+        await pipe.execute()
+
+
+async def observe(name: str, value: float):
+    # Stored as name_sum / name_count, the average is derived when reading
+    key = metrics_key()
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hincrbyfloat(key, f'{name}_sum', value)
+        pipe.hincrby(key, f'{name}_count', 1)
+        pipe.expire(key, METRICS_TTL)
+        await pipe.execute()
+
+
+async def set_gauge(name: str, value: float):
+    await redis.hset('metrics_gauges', name, value)
+
+
+async def get_metrics(day: str = None):
+    return await redis.hgetall(metrics_key(day)), await redis.hgetall('metrics_gauges')
@@ -0,0 +1,64 @@
+"""Prints the query plans of the hot per-request queries.
+
+Compare the plans without and with the indexes from migration 0002:
+
+    python scripts/explain_hot_queries.py --user-id 123456789
+    alembic downgrade 0001
+    python scripts/explain_hot_queries.py --user-id 123456789
+    alembic upgrade head
+
+Plans only switch to the indexes once the tables hold enough rows for a scan to be more expensive.
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import select, and_, asc, desc, func, text
+
+from database.models import engine, ChatMessage, Payment, UserTasks, MemoryVector, Wallet
+from database.repositories.user import message_tokens
+
+
+def hot_queries(user_id: int, suffix: str, task_id: int):
+    window = (select(ChatMessage.id,
+                     func.sum(message_tokens()).over(order_by=desc(ChatMessage.id)).label('running_tokens')).
+              where(ChatMessage.user_id == user_id).
+              subquery())
+
+    return {
+        'history (latest messages)': select(ChatMessage).where(ChatMessage.user_id == user_id).
+        order_by(desc(ChatMessage.id)).limit(201),
+        'history (token window)': select(ChatMessage).join(window, window.c.id == ChatMessage.id).
+        where(window.c.running_tokens <= 20000).order_by(asc(ChatMessage.id)),
+        'payment suffix check': select(Payment).where(Payment.random_suffix == suffix).
+        order_by(desc(Payment.created_at)).limit(1),
+        'user task': select(UserTasks).where(and_(UserTasks.user_id == user_id, UserTasks.id == task_id)),
+        'user tasks': select(UserTasks).where(UserTasks.user_id == user_id),
+        'memory vector': select(MemoryVector).where(MemoryVector.user_id == user_id),
+        'wallet': select(Wallet).where(Wallet.user_id == user_id),
+    }
+
+
+async def main(args):
+    async with engine.connect() as conn:
+        for name, query in hot_queries(args.user_id, args.suffix, args.task_id).items():
+            sql = str(query.compile(conn.sync_connection, compile_kwargs={'literal_binds': True}))
+            options = 'ANALYZE, BUFFERS' if args.analyze else 'COSTS'
+            plan = (await conn.execute(text(f'EXPLAIN ({options}) {sql}'))).scalars().all()
+            print(f'--- {name}')
+            print('\n'.join(plan))
+            print()
+
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--user-id', type=int, required=True)
+    parser.add_argument('--suffix', default='0000')
+    parser.add_argument('--task-id', type=int, default=1)
+    parser.add_argument('--analyze', action='store_true', help='run the queries (EXPLAIN ANALYZE)')
+    asyncio.run(main(parser.parse_args()))